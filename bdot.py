@@ -1,74 +1,265 @@
 #!/usr/bin/env python3
+import argparse
 import asyncio
+import fcntl
+import functools
+import hashlib
+import json
 import logging
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import warnings
 import zipfile
-from dataclasses import dataclass
+from collections import defaultdict, deque
+from contextlib import asynccontextmanager, contextmanager, nullcontext
+from concurrent.futures import (
+    Executor,
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+)
+from dataclasses import asdict, dataclass
+from datetime import datetime, timedelta, timezone
+from itertools import repeat
 from pathlib import Path
+from typing import AsyncIterator, Iterator
 
-import geojson
 import geopandas
 import h3
-from httpx import AsyncClient
+import numpy as np
+import pyogrio
+import shapely
+from h3.api import numpy_int as h3int
+from pyproj import Transformer
 from starsep_utils import logDuration
 from starsep_utils.overpass import DEFAULT_OVERPASS_URL
-from tqdm import tqdm
+
+from cellset import CellSet, unionSortedCells
+from downloads import Downloader
+from jobs import Job, JobQueue
+from overpass import ElementStreamParser, OverpassClient
+from pbf import WayBatch, iterWayBatches, pbfTimestamp, readTerytAreas
+from scheduler import Scheduler, Task
+from writers import WRITERS
+
+with warnings.catch_warnings():
+    warnings.simplefilter("ignore")
+    from h3.unstable import vect as h3vect
 
 H3_RESOLUTION = 12
+# Lines are sampled every H3_SAMPLE_STEP_RATIO * (average edge length), so that
+# consecutive samples fall into the same or neighbouring cells. Cells a line
+# only clips at a corner can fall between samples. At 1.0 about 6% of crossed
+# cells are missed, fewer than h3LineLatLng misses, and halving the step
+# halves that but doubles the geo_to_h3 calls which dominate rasterization.
+H3_SAMPLE_STEP_RATIO = 1.0
+EARTH_RADIUS_M = 6371008.8
+# BDOT feature is considered present in OSM if any of its cells is within
+# OSM_NEIGHBOURHOOD_SIZE cells of OSM data.
+OSM_NEIGHBOURHOOD_SIZE = 1
+# Side of the comparison which gets dilated: "osm", "bdot" or "auto" (smaller one)
+DILATION_SIDE = "auto"
+# BDOT features are first tested against OSM coverage at this resolution and
+# only those close to OSM data are rasterized at H3_RESOLUTION.
+H3_COARSE_RESOLUTION = 7
+# Worker processes comparing BDOT features with OSM, BDOT_CHUNK_SIZE features each
+BDOT_WORKERS = os.cpu_count() or 1
+BDOT_CHUNK_SIZE = 10_000
+# Worker processes rasterizing OSM ways, OSM_CHUNK_SIZE ways each
+OSM_WORKERS = os.cpu_count() or 1
+OSM_CHUNK_SIZE = 20_000
+# Pools are started from threads which may hold GDAL or PROJ locks, a forked
+# child would inherit them locked
+PROCESS_START_METHOD = "forkserver"
+# Bump when a change in rasterization or in the storage format invalidates
+# cached OSM coverage
+COVERAGE_ALGORITHM_VERSION = 3
+# Cached coverage is reused while its OSM data is younger than this
+COVERAGE_CACHE_MAX_AGE = timedelta(days=1)
+COVERAGE_CACHE_MAX_SIZE = 4 * 1024**3
+# Cache entries being written or deleted, skipped by eviction
+CACHE_TEMPORARY_PREFIX = ".tmp-"
+# Keep the cells of every OSM way next to cached coverage and refresh expired
+# coverage with only the ways changed since it was downloaded
+INCREMENTAL_OSM_UPDATES = True
+# Keep BDOT archives after extracting the layers used by THEMES, False deletes them
+KEEP_BDOT_ARCHIVES = True
+# Read BDOT layers straight from the downloaded archives through GDAL /vsizip/
+# instead of extracting them
+READ_BDOT_FROM_ARCHIVE = False
+BDOT_URL = "https://opendata.geoportal.gov.pl/bdot10k/schemat2021/GPKG"
+BDOT_DOWNLOAD_CONCURRENCY = 8
+BDOT_CONNECTIONS_PER_HOST = 4
+OVERPASS_URL = DEFAULT_OVERPASS_URL
+# Overpass queries in flight, the server's slot limit is honoured on top of it
+OVERPASS_CONCURRENCY = 2
+POWIATS_QUERY_TIMEOUT = 60
+OSM_QUERY_TIMEOUT = 25
+# Updates look up changed nodes of all matching ways, which takes much longer
+# for large powiats. A timed out update is partial and must not be applied.
+OSM_UPDATE_QUERY_TIMEOUT = 180
+# HTTP timeouts exceed the [timeout:] of queries by this many seconds
+OVERPASS_TIMEOUT_MARGIN = 30
+# Source of OSM data: "overpass", or "pbf" to read all themes for all powiats
+# from OSM_PBF_FILE in a single pass (requires osmium)
+OSM_SOURCE = "overpass"
+OSM_PBF_FILE = Path("poland-latest.osm.pbf")
+# Format of missing feature files, one of writers.WRITERS
+OUTPUT_FORMAT = "geojson"
+# BDOT layers read at a time
+BDOT_READ_CONCURRENCY = 2
+# Comparisons run at a time, each uses BDOT_WORKERS processes
+COMPARE_CONCURRENCY = 1
+JOBS_FILE = Path("jobs.sqlite")
+# Jobs run at a time by each worker process of the job runner
+JOB_CONCURRENCY = 4
+CITIES = {
+    "Warszawa": "1465",
+    "Gdańsk": "2261",
+    "Kraków": "1261",
+    "Tczew": "2214",
+    "Inowrocław": "0407",
+    "Starachowice": "2611",
+    "Żyrardów": "1438",
+    "Kutno": "1002",
+}
 
 missingDir = Path("missing")
 missingDir.mkdir(exist_ok=True)
 bdotDataDir = Path("bdot-data")
 bdotDataDir.mkdir(exist_ok=True)
+coverageCacheDir = Path("coverage-cache")
+coverageCacheDir.mkdir(exist_ok=True)
+
+
+def overpassWayQuery(osmKey: str, osmValues: tuple[str, ...]) -> str:
+    return f'"{osmKey}"~"^({"|".join(osmValues)})$"'
 
 
 @dataclass(frozen=True)
 class Theme:
     name: str
-    overpassWayQuery: str
+    osmKey: str
+    osmValues: tuple[str, ...]
     bdotLayer: str
+    # Columns written for missing features, None means all but BDOT_METADATA_COLUMNS
+    bdotColumns: tuple[str, ...] | None = None
+    # SQL WHERE clause selecting compared BDOT features
+    bdotWhere: str | None = None
+
+    @property
+    def overpassWayQuery(self) -> str:
+        return overpassWayQuery(self.osmKey, self.osmValues)
 
 
+BDOT_METADATA_COLUMNS = (
+    "WERSJA",
+    "POCZATEKWERSJIOBIEKTU",
+    "PRZESTRZENNAZW",
+    "LOKALNYID",
+    "KATEGORIAISTNIENIA",
+    "KODKARTO10K",
+    "TERYT",
+    "OZNACZENIEZMIANY",
+)
+
 THEMES = [
     Theme(
         name="roads",
-        overpassWayQuery='"highway"~"(service|primary|secondary|tertiary|motorway|residential|unclassified'
-        '|living_street|trunk|trunk_link|primary_link|secondary_link|tertiary_link|motorway_link|pedestrian|track|path|footway)"',
+        osmKey="highway",
+        osmValues=(
+            "service",
+            "primary",
+            "secondary",
+            "tertiary",
+            "motorway",
+            "residential",
+            "unclassified",
+            "living_street",
+            "trunk",
+            "trunk_link",
+            "primary_link",
+            "secondary_link",
+            "tertiary_link",
+            "motorway_link",
+            "pedestrian",
+            "track",
+            "path",
+            "footway",
+        ),
         bdotLayer="OT_SKJZ_L",
     ),
     Theme(
         name="noise_barriers",
-        overpassWayQuery="wall=noise_barrier",
+        osmKey="wall",
+        osmValues=("noise_barrier",),
         bdotLayer="OT_OIKM_L",
-        # TODO: Filter RODZAJ="ekran akustyczny" in BDOT
+        bdotWhere="RODZAJ = 'ekran akustyczny'",
     ),
     Theme(
         name="powerlines",
-        overpassWayQuery='power~"(line|minor_line)"',
+        osmKey="power",
+        osmValues=("line", "minor_line"),
         bdotLayer="OT_SULN_L",
     ),
     Theme(
         name="footways",
-        overpassWayQuery='"highway"~"(footway|path|service|track|pedestrian|living_street)"',
+        osmKey="highway",
+        osmValues=(
+            "footway",
+            "path",
+            "service",
+            "track",
+            "pedestrian",
+            "living_street",
+        ),
         bdotLayer="OT_SKRP_L",
     ),
 ]
 
 
-async def getOSMDataFromOverpass(theme: Theme, teryt: str):
-    query = f"""
-    [out:json][timeout:25];
+async def getOSMDataFromOverpass(
+    wayQuery: str,
+    teryt: str,
+    overpass: OverpassClient,
+    parser: ElementStreamParser,
+    since: str | None = None,
+) -> AsyncIterator[dict]:
+    if since is None:
+        queryTimeout = OSM_QUERY_TIMEOUT
+        query = f"""
+    [out:json][timeout:{queryTimeout}];
     area["teryt:terc"="{teryt}"]->.searchArea;
-    way[{theme.overpassWayQuery}](area.searchArea);
+    way[{wayQuery}](area.searchArea);
     convert item ::=::,::geom=geom(),_osm_type=type();
     out geom;
     """
-    with logDuration("download data from Overpass"):
-        response = await AsyncClient().post(
-            DEFAULT_OVERPASS_URL, data=dict(data=query), timeout=30.0
-        )
-        response.raise_for_status()
-    with logDuration("parsing Overpass response"):
-        return geojson.loads(response.text)["elements"]
+    else:
+        # Ids and tags of all matching ways, to drop deleted ones, followed by
+        # geometries of ways changed since then, directly or through their nodes
+        since = datetime.fromisoformat(since).strftime("%Y-%m-%dT%H:%M:%SZ")
+        queryTimeout = OSM_UPDATE_QUERY_TIMEOUT
+        query = f"""
+    [out:json][timeout:{queryTimeout}];
+    area["teryt:terc"="{teryt}"]->.searchArea;
+    way[{wayQuery}](area.searchArea)->.ways;
+    .ways out tags;
+    node(w.ways)(newer:"{since}")->.changedNodes;
+    (way.ways(newer:"{since}"); way.ways(bn.changedNodes););
+    convert item ::=::,::geom=geom(),_osm_type=type();
+    out geom;
+    """
+    with logDuration("streaming data from Overpass"):
+        async with overpass.stream(
+            query, timeout=queryTimeout + OVERPASS_TIMEOUT_MARGIN
+        ) as response:
+            async for chunk in response.aiter_bytes():
+                for element in parser.feed(chunk):
+                    yield element
+    parser.raiseForIncomplete()
 
 
 def h3LineLatLng(start: tuple[float, float], end: tuple[float, float]) -> set[str]:
@@ -80,118 +271,1475 @@ def h3LineLatLng(start: tuple[float, float], end: tuple[float, float]) -> set[st
     return h3LineLatLng(start, middle) | h3LineLatLng(middle, end)
 
 
-def processLineIntoH3Set(
-    line: list[tuple[float, float]], result: set[str], neighbourhood_size: int = 0
-) -> set[str]:
+def linesToArrays(
+    lines: list[list[tuple[float, float]]],
+) -> tuple[np.ndarray, np.ndarray]:
+    lengths = np.fromiter(
+        (len(line) for line in lines), dtype=np.int64, count=len(lines)
+    )
+    offsets = np.zeros(len(lines) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    coords = np.empty((offsets[-1], 2), dtype=np.float64)
+    for line, start, end in zip(lines, offsets[:-1], offsets[1:]):
+        coords[start:end] = line
+    return coords, offsets
+
+
+def densifyLines(
+    coords: np.ndarray, offsets: np.ndarray, step: float
+) -> tuple[np.ndarray, np.ndarray]:
+    """Sample lines every `step` metres.
+
+    `coords` holds (lon, lat) vertices of all lines, line i spans
+    `coords[offsets[i]:offsets[i + 1]]`. Returns sampled points and the index
+    of the line each of them belongs to.
+    """
+    pointLine = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+    sameLine = pointLine[:-1] == pointLine[1:]
+    segmentStart = coords[:-1][sameLine]
+    segmentEnd = coords[1:][sameLine]
+    segmentLine = pointLine[:-1][sameLine]
+    delta = np.radians(segmentEnd - segmentStart)
+    delta[:, 0] *= np.cos(np.radians((segmentStart[:, 1] + segmentEnd[:, 1]) / 2))
+    lengths = np.hypot(delta[:, 0], delta[:, 1]) * EARTH_RADIUS_M
+    samples = np.maximum(np.ceil(lengths / step), 1).astype(np.int64)
+    sampleSegment = np.repeat(np.arange(len(samples)), samples)
+    firstSample = np.cumsum(samples) - samples
+    t = (np.arange(len(sampleSegment)) - firstSample[sampleSegment]) / samples[
+        sampleSegment
+    ]
+    start = segmentStart[sampleSegment]
+    points = start + t[:, np.newaxis] * (segmentEnd[sampleSegment] - start)
+    # Segments are sampled half-open, vertices close them.
+    return (
+        np.concatenate([points, coords]),
+        np.concatenate([segmentLine[sampleSegment], pointLine]),
+    )
+
+
+def rasterizeLines(
+    coords: np.ndarray, offsets: np.ndarray, resolution: int = H3_RESOLUTION
+) -> np.ndarray:
+    cells, _ = rasterizeLinesWithIndex(coords, offsets, resolution)
+    return np.unique(cells)
+
+
+def rasterizeLinesWithIndex(
+    coords: np.ndarray, offsets: np.ndarray, resolution: int = H3_RESOLUTION
+) -> tuple[np.ndarray, np.ndarray]:
+    step = h3.edge_length(resolution, "m") * H3_SAMPLE_STEP_RATIO
+    points, lineIndex = densifyLines(coords, offsets, step)
+    return h3vect.geo_to_h3(points[:, 1], points[:, 0], resolution), lineIndex
+
+
+def uniqueCellsWithIndex(
+    cells: np.ndarray, index: np.ndarray
+) -> tuple[np.ndarray, np.ndarray]:
+    order = np.lexsort((cells, index))
+    cells, index = cells[order], index[order]
+    keep = np.ones(len(cells), dtype=bool)
+    keep[1:] = (cells[1:] != cells[:-1]) | (index[1:] != index[:-1])
+    return cells[keep], index[keep]
+
+
+def dilateCells(cells: np.ndarray, k: int, index: np.ndarray | None = None):
+    """Expand cells by their k-rings, calling h3 once per distinct cell.
+
+    Returns unique dilated cells, or deduplicated (cell, index) pairs when
+    `index` is given.
+    """
+    if k == 0 or len(cells) == 0:
+        return cells if index is None else (cells, index)
+    uniqueCells, inverse = np.unique(cells, return_inverse=True)
+    # One row per distinct cell, rings of pentagons are shorter and padded
+    # with 0, which is not a valid cell
+    rings = np.zeros((len(uniqueCells), 3 * k * (k + 1) + 1), dtype=np.uint64)
+    for row, cell in zip(rings, uniqueCells.tolist()):
+        ring = h3int.k_ring(cell, k)
+        row[: len(ring)] = ring
+    if index is None:
+        neighbours = np.unique(rings)
+        return neighbours[neighbours != 0]
+    neighbours = rings[inverse]
+    valid = neighbours != 0
+    return uniqueCellsWithIndex(neighbours[valid], np.repeat(index, valid.sum(axis=1)))
+
+
+def isInSorted(sortedCells: np.ndarray, cells: np.ndarray) -> np.ndarray:
+    if len(sortedCells) == 0:
+        return np.zeros(len(cells), dtype=bool)
+    index = np.searchsorted(sortedCells, cells)
+    index[index == len(sortedCells)] = 0
+    return sortedCells[index] == cells
+
+
+def h3LineLatLngCells(line: list[tuple[float, float]]) -> np.ndarray:
+    cells = set()
     for pointA, pointB in zip(line[:-1], line[1:]):
-        for point in h3LineLatLng(pointA, pointB):
-            result.update(h3.k_ring(point, neighbourhood_size))
-    return result
+        cells |= h3LineLatLng(pointA, pointB)
+    return np.unique(np.fromiter(map(h3.string_to_h3, cells), dtype=np.uint64))
+
+
+def processLineIntoH3Set(
+    line: list[tuple[float, float]],
+    neighbourhood_size: int = 0,
+    vectorized: bool = True,
+) -> np.ndarray:
+    if vectorized:
+        cells = rasterizeLines(*linesToArrays([line]))
+    else:
+        cells = h3LineLatLngCells(line)
+    return dilateCells(cells, neighbourhood_size)
+
+
+@dataclass(frozen=True)
+class Coverage:
+    cells: CellSet
+    coarseCells: np.ndarray
+    # How many rings of neighbours are already included in cells
+    neighbourhoodSize: int = 0
+
+
+def makeCoverage(cells: np.ndarray) -> Coverage:
+    return Coverage(
+        cells=CellSet.fromCells(cells, H3_RESOLUTION),
+        coarseCells=np.unique(h3vect.h3_to_parent(cells, H3_COARSE_RESOLUTION)),
+    )
+
+
+def dilateCoverage(coverage: Coverage, neighbourhood_size: int) -> Coverage:
+    if neighbourhood_size <= coverage.neighbourhoodSize:
+        return coverage
+    return Coverage(
+        cells=CellSet.fromCells(
+            dilateCells(
+                coverage.cells.toCells(),
+                neighbourhood_size - coverage.neighbourhoodSize,
+            ),
+            H3_RESOLUTION,
+        ),
+        coarseCells=coverage.coarseCells,
+        neighbourhoodSize=neighbourhood_size,
+    )
+
+
+@dataclass(frozen=True)
+class WayCells:
+    """Cells of OSM ways, way i covers cells[offsets[i]:offsets[i + 1]]."""
+
+    # Sorted
+    wayIds: np.ndarray
+    offsets: np.ndarray
+    cells: np.ndarray
+
+
+def selectWays(wayCells: WayCells, rows: np.ndarray) -> WayCells:
+    lengths = np.diff(wayCells.offsets)[rows]
+    offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    within = np.arange(offsets[-1]) - np.repeat(offsets[:-1], lengths)
+    return WayCells(
+        wayIds=wayCells.wayIds[rows],
+        offsets=offsets,
+        cells=wayCells.cells[np.repeat(wayCells.offsets[:-1][rows], lengths) + within],
+    )
+
+
+def concatWayCells(parts: list[WayCells]) -> WayCells:
+    if not parts:
+        return WayCells(
+            wayIds=np.empty(0, dtype=np.int64),
+            offsets=np.zeros(1, dtype=np.int64),
+            cells=np.empty(0, dtype=np.uint64),
+        )
+    cellCounts = np.cumsum([0] + [len(part.cells) for part in parts[:-1]])
+    merged = WayCells(
+        wayIds=np.concatenate([part.wayIds for part in parts]),
+        offsets=np.concatenate(
+            [[0]] + [part.offsets[1:] + count for part, count in zip(parts, cellCounts)]
+        ).astype(np.int64),
+        cells=np.concatenate([part.cells for part in parts]),
+    )
+    return selectWays(merged, np.argsort(merged.wayIds, kind="stable"))
+
+
+def patchWayCells(
+    previous: WayCells, currentWayIds: np.ndarray, changed: WayCells
+) -> WayCells:
+    """Drops ways which no longer match and replaces changed ones."""
+    keep = isInSorted(np.sort(currentWayIds), previous.wayIds) & ~isInSorted(
+        changed.wayIds, previous.wayIds
+    )
+    return concatWayCells([selectWays(previous, np.flatnonzero(keep)), changed])
+
+
+def saveWayCells(wayCells: WayCells, directory: Path):
+    np.save(directory / "wayIds.npy", wayCells.wayIds)
+    np.save(directory / "wayOffsets.npy", wayCells.offsets)
+    np.save(directory / "wayCells.npy", wayCells.cells)
+
+
+def loadWayCells(directory: Path) -> WayCells:
+    return WayCells(
+        wayIds=np.load(directory / "wayIds.npy"),
+        offsets=np.load(directory / "wayOffsets.npy"),
+        cells=np.load(directory / "wayCells.npy"),
+    )
+
+
+def saveCoverage(coverage: Coverage, directory: Path):
+    coverage.cells.save(directory, "cells")
+    np.save(directory / "coarseCells.npy", coverage.coarseCells)
+    with (directory / "coverage.json").open("w") as f:
+        json.dump(dict(neighbourhoodSize=coverage.neighbourhoodSize), f)
+
+
+def loadCoverage(directory: Path, mmap: bool = False) -> Coverage:
+    mmapMode = "r" if mmap else None
+    with (directory / "coverage.json").open() as f:
+        metadata = json.load(f)
+    return Coverage(
+        cells=CellSet.load(directory, "cells", mmap=mmap),
+        coarseCells=np.load(directory / "coarseCells.npy", mmap_mode=mmapMode),
+        neighbourhoodSize=metadata["neighbourhoodSize"],
+    )
+
+
+def selectLines(
+    coords: np.ndarray, offsets: np.ndarray, mask: np.ndarray
+) -> tuple[np.ndarray, np.ndarray]:
+    lengths = np.diff(offsets)
+    selectedOffsets = np.zeros(mask.sum() + 1, dtype=np.int64)
+    np.cumsum(lengths[mask], out=selectedOffsets[1:])
+    return coords[np.repeat(mask, lengths)], selectedOffsets
+
+
+def findLinesNearCoverage(
+    coords: np.ndarray, offsets: np.ndarray, coverage: Coverage
+) -> np.ndarray:
+    cells, lineIndex = uniqueCellsWithIndex(
+        *rasterizeLinesWithIndex(coords, offsets, H3_COARSE_RESOLUTION)
+    )
+    # Fine cells near a line may have parents next to the coarse cells the line
+    # passes through, one ring of margin keeps the prefilter exact.
+    cells, lineIndex = dilateCells(cells, 1, lineIndex)
+    near = np.bincount(
+        lineIndex[isInSorted(coverage.coarseCells, cells)],
+        minlength=len(offsets) - 1,
+    )
+    return near > 0
+
+
+def shouldDilateBdot(bdotCells: np.ndarray, osmCells: CellSet) -> bool:
+    if DILATION_SIDE == "auto":
+        return len(np.unique(bdotCells)) < len(osmCells)
+    return DILATION_SIDE == "bdot"
+
+
+def findMissingLines(
+    coords: np.ndarray,
+    offsets: np.ndarray,
+    coverage: Coverage,
+    neighbourhood_size: int = 0,
+) -> np.ndarray:
+    candidates = findLinesNearCoverage(coords, offsets, coverage)
+    cells, lineIndex = uniqueCellsWithIndex(
+        *rasterizeLinesWithIndex(*selectLines(coords, offsets, candidates))
+    )
+    neighbourhood_size -= coverage.neighbourhoodSize
+    if neighbourhood_size > 0 and not shouldDilateBdot(cells, coverage.cells):
+        isShared = isInSorted(
+            dilateCells(coverage.cells.toCells(), neighbourhood_size), cells
+        )
+    else:
+        if neighbourhood_size > 0:
+            cells, lineIndex = dilateCells(cells, neighbourhood_size, lineIndex)
+        isShared = coverage.cells.contains(cells)
+    shared = np.bincount(lineIndex[isShared], minlength=candidates.sum())
+    missing = np.ones(len(candidates), dtype=bool)
+    missing[candidates] = shared == 0
+    return missing
+
+
+def coverageCacheKey(wayQuery: str, teryt: str, neighbourhood_size: int) -> str:
+    key = dict(
+        overpassWayQuery=wayQuery,
+        teryt=teryt,
+        resolution=H3_RESOLUTION,
+        coarseResolution=H3_COARSE_RESOLUTION,
+        sampleStepRatio=H3_SAMPLE_STEP_RATIO,
+        neighbourhoodSize=neighbourhood_size,
+        version=COVERAGE_ALGORITHM_VERSION,
+    )
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+def readCachedCoverage(key: str, notBefore: str | None = None) -> Coverage | None:
+    """Cached coverage younger than COVERAGE_CACHE_MAX_AGE, or than `notBefore`."""
+    directory = coverageCacheDir / key
+    try:
+        with (directory / "cache.json").open() as f:
+            metadata = json.load(f)
+    except FileNotFoundError:
+        return None
+    osmTimestamp = datetime.fromisoformat(metadata["osmTimestamp"])
+    if notBefore is not None:
+        if osmTimestamp < datetime.fromisoformat(notBefore):
+            return None
+    elif datetime.now(timezone.utc) - osmTimestamp > COVERAGE_CACHE_MAX_AGE:
+        return None
+    try:
+        # Directory mtime marks last use for eviction
+        os.utime(directory)
+        return loadCoverage(directory)
+    except FileNotFoundError:
+        # Replaced by another worker process while being read
+        return None
+
+
+def readCachedWayCells(key: str) -> tuple[WayCells, str] | None:
+    """Cells of ways behind cached coverage, even expired, with their timestamp."""
+    directory = coverageCacheDir / key
+    try:
+        with (directory / "cache.json").open() as f:
+            metadata = json.load(f)
+        return loadWayCells(directory), metadata["osmTimestamp"]
+    except FileNotFoundError:
+        return None
+
+
+def writeCachedCoverage(
+    key: str,
+    coverage: Coverage,
+    osmTimestamp: str,
+    wayCells: WayCells | None = None,
+    evict: bool = True,
+):
+    temporaryDirectory = Path(
+        tempfile.mkdtemp(prefix=CACHE_TEMPORARY_PREFIX, dir=coverageCacheDir)
+    )
+    saveCoverage(coverage, temporaryDirectory)
+    if wayCells is not None:
+        saveWayCells(wayCells, temporaryDirectory)
+    with (temporaryDirectory / "cache.json").open("w") as f:
+        json.dump(dict(osmTimestamp=osmTimestamp), f)
+    directory = coverageCacheDir / key
+    # The stale entry is renamed aside before it is deleted, so that readers
+    # see a whole entry or none
+    staleDirectory = Path(
+        tempfile.mkdtemp(prefix=CACHE_TEMPORARY_PREFIX, dir=coverageCacheDir)
+    )
+    try:
+        directory.rename(staleDirectory / key)
+    except FileNotFoundError:
+        pass
+    try:
+        temporaryDirectory.rename(directory)
+    except OSError:
+        # Another worker process cached the same coverage in the meantime
+        shutil.rmtree(temporaryDirectory, ignore_errors=True)
+    shutil.rmtree(staleDirectory, ignore_errors=True)
+    if evict:
+        evictCoverageCache()
+
+
+def cacheEntryUsage(entry: Path) -> tuple[float, int] | None:
+    """Last use and size of a cache entry, None if it is gone."""
+    try:
+        return entry.stat().st_mtime, sum(f.stat().st_size for f in entry.iterdir())
+    except FileNotFoundError:
+        # Evicted or replaced by another writer
+        return None
+
+
+def evictCoverageCache(maxSize: int = COVERAGE_CACHE_MAX_SIZE):
+    # Writers of other threads and processes keep adding and replacing entries
+    with fileLock(coverageCacheDir / "evict.lock"):
+        entries = []
+        for entry in coverageCacheDir.iterdir():
+            if not entry.is_dir() or entry.name.startswith(CACHE_TEMPORARY_PREFIX):
+                continue
+            usage = cacheEntryUsage(entry)
+            if usage is not None:
+                entries.append((*usage, entry))
+        totalSize = sum(size for _, size, _ in entries)
+        for _, size, entry in sorted(entries):
+            if totalSize <= maxSize:
+                break
+            logging.info(f"Evicting cached coverage {entry.name}")
+            shutil.rmtree(entry, ignore_errors=True)
+            totalSize -= size
+
+
+def splitLines(
+    coords: np.ndarray, offsets: np.ndarray, chunkSize: int
+) -> list[tuple[np.ndarray, np.ndarray]]:
+    lineCount = len(offsets) - 1
+    bounds = list(range(0, lineCount, chunkSize)) + [lineCount]
+    return [
+        (
+            coords[offsets[start] : offsets[end]],
+            offsets[start : end + 1] - offsets[start],
+        )
+        for start, end in zip(bounds[:-1], bounds[1:])
+    ]
+
+
+def processPool(**kwargs) -> ProcessPoolExecutor:
+    return ProcessPoolExecutor(
+        mp_context=multiprocessing.get_context(PROCESS_START_METHOD), **kwargs
+    )
+
+
+_workerCoverage: Coverage | None = None
+
+
+def _initCoverageWorker(coverageDirectory: str):
+    global _workerCoverage
+    _workerCoverage = loadCoverage(Path(coverageDirectory), mmap=True)
+
+
+def _findMissingLinesInWorker(
+    coords: np.ndarray, offsets: np.ndarray, neighbourhood_size: int
+) -> np.ndarray:
+    return findMissingLines(coords, offsets, _workerCoverage, neighbourhood_size)
+
+
+def iterMissingLines(
+    coords: np.ndarray,
+    offsets: np.ndarray,
+    coverage: Coverage,
+    neighbourhood_size: int = 0,
+    workers: int = BDOT_WORKERS,
+    chunkSize: int = BDOT_CHUNK_SIZE,
+) -> Iterator[np.ndarray]:
+    """Yields missing line masks of consecutive chunks of lines, in order."""
+    chunks = splitLines(coords, offsets, chunkSize)
+    if workers <= 1 or len(chunks) <= 1:
+        for chunkCoords, chunkOffsets in chunks:
+            yield findMissingLines(
+                chunkCoords, chunkOffsets, coverage, neighbourhood_size
+            )
+        return
+    if DILATION_SIDE == "osm":
+        coverage = dilateCoverage(coverage, neighbourhood_size)
+    chunkCoords, chunkOffsets = zip(*chunks)
+    # Workers memory-map the coverage instead of receiving a pickled copy per task
+    with tempfile.TemporaryDirectory() as coverageDirectory:
+        saveCoverage(coverage, Path(coverageDirectory))
+        with processPool(
+            max_workers=min(workers, len(chunkCoords)),
+            initializer=_initCoverageWorker,
+            initargs=(coverageDirectory,),
+        ) as executor:
+            yield from executor.map(
+                _findMissingLinesInWorker,
+                chunkCoords,
+                chunkOffsets,
+                repeat(neighbourhood_size),
+            )
+
+
+def findMissingLinesParallel(
+    coords: np.ndarray,
+    offsets: np.ndarray,
+    coverage: Coverage,
+    neighbourhood_size: int = 0,
+    workers: int = BDOT_WORKERS,
+    chunkSize: int = BDOT_CHUNK_SIZE,
+) -> np.ndarray:
+    masks = iterMissingLines(
+        coords, offsets, coverage, neighbourhood_size, workers, chunkSize
+    )
+    return np.concatenate([np.zeros(0, dtype=bool), *masks])
+
+
+def _rasterizeOSMWays(
+    coords: np.ndarray, offsets: np.ndarray, wayIds: np.ndarray
+) -> WayCells:
+    cells, lineIndex = uniqueCellsWithIndex(*rasterizeLinesWithIndex(coords, offsets))
+    wayOffsets = np.zeros(len(wayIds) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(lineIndex, minlength=len(wayIds)), out=wayOffsets[1:])
+    wayCells = WayCells(wayIds=wayIds, offsets=wayOffsets, cells=cells)
+    return selectWays(wayCells, np.argsort(wayIds, kind="stable"))
+
+
+def _rasterizeOSMChunk(
+    coords: np.ndarray, offsets: np.ndarray, neighbourhood_size: int
+) -> np.ndarray:
+    return dilateCells(rasterizeLines(coords, offsets), neighbourhood_size)
+
+
+def rasterizeOSMLinesParallel(
+    coords: np.ndarray,
+    offsets: np.ndarray,
+    neighbourhood_size: int = 0,
+    workers: int = OSM_WORKERS,
+    chunkSize: int = OSM_CHUNK_SIZE,
+) -> np.ndarray:
+    if workers <= 1 or len(offsets) - 1 <= chunkSize:
+        return _rasterizeOSMChunk(coords, offsets, neighbourhood_size)
+    chunkCoords, chunkOffsets = zip(*splitLines(coords, offsets, chunkSize))
+    with processPool(max_workers=min(workers, len(chunkCoords))) as executor:
+        parts = executor.map(
+            _rasterizeOSMChunk, chunkCoords, chunkOffsets, repeat(neighbourhood_size)
+        )
+        return unionSortedCells(list(parts))
 
 
 @logDuration
-def processOSMDataIntoH3Set(osmData) -> set[str]:
-    result = set()
+def processOSMDataIntoH3Set(
+    osmData, vectorized: bool = True, neighbourhood_size: int = 1
+) -> np.ndarray:
+    lines = []
     for element in osmData:
         if element["geometry"]["type"] != "LineString":
             print(f'Unsupported geometry type {element["geometry"]["type"]}')
             continue
-        coords = element["geometry"]["coordinates"]
-        result = processLineIntoH3Set(coords, result, neighbourhood_size=1)
-    return result
-
-
-async def getBdotData(theme: Theme, teryt: str):
-    with logDuration("reading BDOT data in GeoPackage format"):
-        bdotData = geopandas.read_file(
-            list(bdotDataDir.glob(f"*.BDOT10k.{teryt}__{theme.bdotLayer}.gpkg"))[0]
-        )
-    bdotData = bdotData.drop(
-        columns=[
-            "WERSJA",
-            "POCZATEKWERSJIOBIEKTU",
-            "PRZESTRZENNAZW",
-            "LOKALNYID",
-            "KATEGORIAISTNIENIA",
-            "KODKARTO10K",
-            "TERYT",
-            "OZNACZENIEZMIANY",
+        lines.append(element["geometry"]["coordinates"])
+    if not lines:
+        return np.empty(0, dtype=np.uint64)
+    if vectorized:
+        return rasterizeOSMLinesParallel(
+            *linesToArrays(lines), neighbourhood_size=neighbourhood_size
+        )
+    cells = np.unique(np.concatenate([h3LineLatLngCells(line) for line in lines]))
+    return dilateCells(cells, neighbourhood_size)
+
+
+@dataclass(frozen=True)
+class BdotLines:
+    theme: Theme
+    path: str
+    fids: np.ndarray
+    coords: np.ndarray
+    offsets: np.ndarray
+
+
+def bdotLayerFileSuffix(theme: Theme, teryt: str) -> str:
+    return f".BDOT10k.{teryt}__{theme.bdotLayer}.gpkg"
+
+
+def bdotArchivePath(teryt: str) -> Path:
+    return bdotDataDir / f"{teryt}_GPKG.zip"
+
+
+@functools.cache
+def bdotArchiveMemberNames(archivePath: Path) -> tuple[str, ...]:
+    with zipfile.ZipFile(archivePath) as archive:
+        return tuple(archive.namelist())
+
+
+def bdotLayerPath(theme: Theme, teryt: str) -> str:
+    suffix = bdotLayerFileSuffix(theme, teryt)
+    if READ_BDOT_FROM_ARCHIVE:
+        archivePath = bdotArchivePath(teryt)
+        [member] = [
+            name
+            for name in bdotArchiveMemberNames(archivePath)
+            if name.endswith(suffix)
         ]
+        return f"/vsizip/{archivePath}/{member}"
+    return str(list(bdotDataDir.glob(f"*{suffix}"))[0])
+
+
+def readBdotLines(theme: Theme, teryt: str) -> BdotLines:
+    path = bdotLayerPath(theme, teryt)
+    with logDuration("reading BDOT geometries in GeoPackage format"):
+        geometries = geopandas.read_file(
+            path, columns=[], where=theme.bdotWhere, fid_as_index=True
+        ).geometry
+    typeIds = shapely.get_type_id(geometries.values)
+    isLine = typeIds == shapely.GeometryType.LINESTRING
+    for typeId, count in zip(*np.unique(typeIds[~isLine], return_counts=True)):
+        print(
+            f"Unsupported geometry type {shapely.GeometryType(typeId).name} ({count}x)"
+        )
+    lines = geometries.values[isLine]
+    offsets = np.zeros(len(lines) + 1, dtype=np.int64)
+    np.cumsum(shapely.get_num_coordinates(lines), out=offsets[1:])
+    coords = shapely.get_coordinates(lines)
+    with logDuration("reprojecting BDOT coordinates to WGS84"):
+        transformer = Transformer.from_crs(geometries.crs, "EPSG:4326", always_xy=True)
+        coords = np.column_stack(transformer.transform(coords[:, 0], coords[:, 1]))
+    return BdotLines(
+        theme=theme,
+        path=path,
+        fids=geometries.index.values[isLine],
+        coords=coords,
+        offsets=offsets,
     )
-    with logDuration("converting BDOT data to GeoJSON"):
-        geojsonBdotDataString = bdotData.to_json(to_wgs84=True)
-    with logDuration("parsing BDOT GeoJSON"):
-        geojsonBdotData = geojson.loads(geojsonBdotDataString)
-    return geojsonBdotData
 
 
-async def getOSMData(theme: Theme, teryt: str):
-    osmData = await getOSMDataFromOverpass(theme, teryt)
-    return processOSMDataIntoH3Set(osmData)
+async def getBdotData(theme: Theme, teryt: str) -> BdotLines:
+    return await asyncio.to_thread(readBdotLines, theme, teryt)
 
 
-async def processTheme(theme: Theme, teryt: str):
-    outputFile = missingDir / f"{theme.name}-{teryt}.geojson"
-    if outputFile.exists():
-        return
+def bdotColumns(bdotLines: BdotLines) -> list[str]:
+    if bdotLines.theme.bdotColumns is not None:
+        return list(bdotLines.theme.bdotColumns)
+    fields = pyogrio.read_info(bdotLines.path)["fields"]
+    return [field for field in fields if field not in BDOT_METADATA_COLUMNS]
+
 
-    [osmH3Set, geojsonBdotData] = await asyncio.gather(
-        getOSMData(theme, teryt), getBdotData(theme, teryt)
+def readBdotFeatures(bdotLines: BdotLines, fids: np.ndarray) -> geopandas.GeoDataFrame:
+    return geopandas.read_file(
+        bdotLines.path, columns=bdotColumns(bdotLines), fids=fids, fid_as_index=True
     )
 
-    outputFeatures = []
-    for feature in geojsonBdotData["features"]:
-        if feature["geometry"]["type"] != "LineString":
-            print(f'Unsupported geometry type {feature["geometry"]["type"]}')
-            continue
-        coords = feature["geometry"]["coordinates"]
-        h3SetFeature = processLineIntoH3Set(coords, set(), neighbourhood_size=0)
-        shared = h3SetFeature & osmH3Set
-        if len(shared) == 0:
-            outputFeatures.append(feature)
-    with logDuration("writing missing features to GeoJSON"):
-        with outputFile.open("w") as f:
-            geojson.dump(geojson.FeatureCollection(outputFeatures), f)
-
-
-async def downloadBdot(teryt: str):
-    url = f"https://opendata.geoportal.gov.pl/bdot10k/schemat2021/GPKG/{teryt[:2]}/{teryt}_GPKG.zip"
-    file = bdotDataDir / f"{teryt}_GPKG.zip"
-    if not file.exists():
-        logging.info(f"Downloading {url}")
-        async with AsyncClient() as client:
-            response = await client.get(url)
-            response.raise_for_status()
-            with file.open("wb") as f:
-                f.write(response.content)
-        with zipfile.ZipFile(file) as z:
-            z.extractall(bdotDataDir)
-    else:
-        logging.info(f"File {file} already exists")
-
-
-async def main():
-    terytCodes = {
-        "Warszawa": "1465",
-        "Gdańsk": "2261",
-        "Kraków": "1261",
-        "Tczew": "2214",
-        "Inowrocław": "0407",
-        "Starachowice": "2611",
-        "Żyrardów": "1438",
-        "Kutno": "1002",
+
+def rasterizationExecutor() -> Executor:
+    if OSM_WORKERS > 1:
+        return processPool(max_workers=OSM_WORKERS)
+    return ThreadPoolExecutor(max_workers=1)
+
+
+async def rasterizeOSMStream(
+    elements: AsyncIterator[dict], osmKey: str, osmValues: tuple[str, ...]
+) -> tuple[dict[str, WayCells], dict[str, np.ndarray]]:
+    """Rasterizes ways with geometry and collects ids of ways without it."""
+    # Ways are rasterized in batches while the rest of the response is still
+    # being received, only the current batch is kept in memory.
+    loop = asyncio.get_running_loop()
+    batches = {value: [] for value in osmValues}
+    batchIds = {value: [] for value in osmValues}
+    parts = {value: [] for value in osmValues}
+    listedIds = {value: [] for value in osmValues}
+    with rasterizationExecutor() as executor:
+
+        def submit(value: str):
+            parts[value].append(
+                loop.run_in_executor(
+                    executor,
+                    _rasterizeOSMWays,
+                    *linesToArrays(batches[value]),
+                    np.array(batchIds[value], dtype=np.int64),
+                )
+            )
+            batches[value] = []
+            batchIds[value] = []
+
+        async for element in elements:
+            value = element["tags"].get(osmKey)
+            if value not in batches:
+                continue
+            if "geometry" not in element:
+                listedIds[value].append(element["id"])
+                continue
+            if element["geometry"]["type"] != "LineString":
+                print(f'Unsupported geometry type {element["geometry"]["type"]}')
+                continue
+            batches[value].append(element["geometry"]["coordinates"])
+            batchIds[value].append(element["id"])
+            if len(batches[value]) >= OSM_CHUNK_SIZE:
+                submit(value)
+        for value in osmValues:
+            if batches[value]:
+                submit(value)
+        wayCells = {
+            value: await asyncio.to_thread(
+                concatWayCells, await asyncio.gather(*parts[value])
+            )
+            for value in osmValues
+        }
+        return wayCells, {
+            value: np.array(ids, dtype=np.int64) for value, ids in listedIds.items()
+        }
+
+
+def unionCoverages(coverages: list[Coverage]) -> Coverage:
+    return Coverage(
+        cells=coverages[0].cells.union(*(coverage.cells for coverage in coverages[1:])),
+        coarseCells=unionSortedCells([coverage.coarseCells for coverage in coverages]),
+        neighbourhoodSize=min(
+            (coverage.neighbourhoodSize for coverage in coverages), default=0
+        ),
+    )
+
+
+def cachedNeighbourhoodSize() -> int:
+    return OSM_NEIGHBOURHOOD_SIZE if DILATION_SIDE == "osm" else 0
+
+
+def valueCacheKeys(
+    osmKey: str, osmValues: tuple[str, ...], teryt: str
+) -> dict[str, str]:
+    # Coverage is built and cached per tag value, so that themes querying
+    # overlapping values (roads and footways) share it.
+    return {
+        value: coverageCacheKey(
+            overpassWayQuery(osmKey, (value,)), teryt, cachedNeighbourhoodSize()
+        )
+        for value in osmValues
+    }
+
+
+def cacheCoverage(
+    key: str,
+    wayCells: WayCells,
+    neighbourhood_size: int,
+    osmTimestamp: str,
+    evict: bool = True,
+) -> Coverage:
+    coverage = dilateCoverage(
+        makeCoverage(np.unique(wayCells.cells)), neighbourhood_size
+    )
+    writeCachedCoverage(
+        key,
+        coverage,
+        osmTimestamp,
+        wayCells if INCREMENTAL_OSM_UPDATES else None,
+        evict,
+    )
+    return coverage
+
+
+async def downloadWayCells(
+    osmKey: str,
+    osmValues: tuple[str, ...],
+    teryt: str,
+    overpass: OverpassClient,
+    since: str | None = None,
+) -> tuple[dict[str, WayCells], dict[str, np.ndarray], str]:
+    parser = ElementStreamParser()
+    wayCells, listedIds = await rasterizeOSMStream(
+        getOSMDataFromOverpass(
+            overpassWayQuery(osmKey, osmValues), teryt, overpass, parser, since
+        ),
+        osmKey,
+        osmValues,
+    )
+    osmTimestamp = parser.timestampOsmBase or datetime.now(timezone.utc).isoformat()
+    return wayCells, listedIds, osmTimestamp
+
+
+async def updateWayCells(
+    osmKey: str,
+    osmValues: tuple[str, ...],
+    teryt: str,
+    overpass: OverpassClient,
+    previous: dict[str, tuple[WayCells, str]],
+) -> tuple[dict[str, WayCells], str]:
+    """Patches previous way cells with ways changed since the oldest of them."""
+    since = min(
+        (timestamp for _, timestamp in previous.values()),
+        key=datetime.fromisoformat,
+    )
+    changed, listedIds, osmTimestamp = await downloadWayCells(
+        osmKey, osmValues, teryt, overpass, since
+    )
+    # Unchanged ways which started to match, e.g. after the boundary of the
+    # area moved, are in neither previous nor changed way cells
+    unknownValues = tuple(
+        value
+        for value in osmValues
+        if len(
+            np.setdiff1d(
+                listedIds[value],
+                np.concatenate([previous[value][0].wayIds, changed[value].wayIds]),
+            )
+        )
+    )
+    patched = {
+        value: await asyncio.to_thread(
+            patchWayCells, previous[value][0], listedIds[value], changed[value]
+        )
+        for value in osmValues
+        if value not in unknownValues
+    }
+    logging.info(
+        f"Updated OSM coverage of {teryt} with "
+        f"{sum(len(ways.wayIds) for ways in changed.values())} ways changed "
+        f"since {since}"
+    )
+    if unknownValues:
+        logging.info(
+            f"Downloading {', '.join(unknownValues)} of {teryt} again, "
+            f"unchanged ways started to match"
+        )
+        # The update timestamp is the older one, later updates start from it
+        full, _, _ = await downloadWayCells(osmKey, unknownValues, teryt, overpass)
+        patched.update(full)
+    return patched, osmTimestamp
+
+
+# Coverage being downloaded, by cache key
+pendingCoverages: dict[str, asyncio.Future] = {}
+
+
+async def getOSMData(theme: Theme, teryt: str, overpass: OverpassClient) -> Coverage:
+    if OSM_SOURCE == "pbf":
+        return await getOSMDataFromPbf(theme, teryt)
+    neighbourhoodSize = cachedNeighbourhoodSize()
+    cacheKeys = valueCacheKeys(theme.osmKey, theme.osmValues, teryt)
+    coverages = {value: readCachedCoverage(key) for value, key in cacheKeys.items()}
+    # Values another theme is downloading right now are awaited, not queried again
+    pending = {
+        value: pendingCoverages[key]
+        for value, key in cacheKeys.items()
+        if coverages[value] is None and key in pendingCoverages
     }
-    for teryt in tqdm(terytCodes.values()):
-        await downloadBdot(teryt)
-        for theme in tqdm(THEMES):
-            await processTheme(theme, teryt)
+    missingValues = tuple(
+        value
+        for value in theme.osmValues
+        if coverages[value] is None and value not in pending
+    )
+    if len(missingValues) < len(theme.osmValues):
+        logging.info(
+            f"Reusing cached or pending OSM coverage for {theme.name} {teryt}, "
+            f"downloading {len(missingValues)} of {len(theme.osmValues)} tag values"
+        )
+    if missingValues:
+        loop = asyncio.get_running_loop()
+        futures = {value: loop.create_future() for value in missingValues}
+        pendingCoverages.update({cacheKeys[value]: futures[value] for value in futures})
+        try:
+            previous = {}
+            if INCREMENTAL_OSM_UPDATES:
+                for value in missingValues:
+                    cached = readCachedWayCells(cacheKeys[value])
+                    if cached is not None:
+                        previous[value] = cached
+            fullValues = tuple(
+                value for value in missingValues if value not in previous
+            )
+            downloads = []
+            if previous:
+                downloads.append(
+                    updateWayCells(
+                        theme.osmKey, tuple(previous), teryt, overpass, previous
+                    )
+                )
+            if fullValues:
+                downloads.append(
+                    downloadWayCells(theme.osmKey, fullValues, teryt, overpass)
+                )
+            for wayCells, *_, osmTimestamp in await asyncio.gather(*downloads):
+                for value, valueWayCells in wayCells.items():
+                    coverages[value] = await asyncio.to_thread(
+                        cacheCoverage,
+                        cacheKeys[value],
+                        valueWayCells,
+                        neighbourhoodSize,
+                        osmTimestamp,
+                    )
+                    futures[value].set_result(coverages[value])
+        except BaseException as e:
+            for future in futures.values():
+                if future.done():
+                    continue
+                if isinstance(e, Exception):
+                    future.set_exception(e)
+                    # Marks the exception retrieved, there may be no other theme waiting
+                    future.exception()
+                else:
+                    future.cancel()
+            raise
+        finally:
+            for value in missingValues:
+                del pendingCoverages[cacheKeys[value]]
+    for value, future in pending.items():
+        coverages[value] = await asyncio.shield(future)
+    return unionCoverages(list(coverages.values()))
+
+
+def _assignWaysToAreas(
+    batch: WayBatch,
+    wayCells: WayCells,
+    areaTree: shapely.STRtree,
+    terytCodes: list[str],
+) -> dict[tuple[str, str, str], WayCells]:
+    """Splits cells of a batch of ways by teryt area and tag."""
+    lines = shapely.linestrings(
+        batch.coords,
+        indices=np.repeat(np.arange(len(batch.wayIds)), np.diff(batch.offsets)),
+    )
+    lineRows, areaRows = areaTree.query(lines, predicate="intersects")
+    tags = list(zip(batch.keys, batch.values))
+    tagNames, tagCodes = np.unique(
+        np.array([f"{key}={value}" for key, value in tags]), return_inverse=True
+    )
+    groups = areaRows * len(tagNames) + tagCodes[lineRows]
+    order = np.argsort(groups, kind="stable")
+    groupValues, groupStarts = np.unique(groups[order], return_index=True)
+    parts = {}
+    for group, rows in zip(groupValues, np.split(lineRows[order], groupStarts[1:])):
+        part = selectWays(wayCells, rows)
+        key, value = tags[rows[0]]
+        parts[terytCodes[group // len(tagNames)], key, value] = WayCells(
+            wayIds=batch.wayIds[rows], offsets=part.offsets, cells=part.cells
+        )
+    return parts
+
+
+def buildCoverageFromPbf(pbfFile: Path, themes: list[Theme]):
+    """Caches coverage of all tag values of `themes` in all powiats of the extract.
+
+    Ways are read in one pass and rasterized in batches, at most two per
+    worker are in memory at a time. Their cells are spooled to a file per
+    powiat and tag, and only one such file is read back at a time.
+    """
+    osmTimestamp = pbfTimestamp(pbfFile)
+    with logDuration("reading powiat boundaries from PBF"):
+        areas = readTerytAreas(pbfFile)
+    terytCodes = list(areas)
+    areaTree = shapely.STRtree([areas[teryt] for teryt in terytCodes])
+    tagFilter = defaultdict(set)
+    for theme in themes:
+        tagFilter[theme.osmKey].update(theme.osmValues)
+    with tempfile.TemporaryDirectory(
+        prefix=CACHE_TEMPORARY_PREFIX, dir=coverageCacheDir
+    ) as spoolDirectory:
+        spoolFiles = {}
+
+        def collect(batch: WayBatch, future: Future):
+            assigned = _assignWaysToAreas(batch, future.result(), areaTree, terytCodes)
+            for areaTag, wayCells in assigned.items():
+                if areaTag not in spoolFiles:
+                    spoolFiles[areaTag] = Path(spoolDirectory) / f"{len(spoolFiles)}"
+                with spoolFiles[areaTag].open("ab") as f:
+                    np.unique(wayCells.cells).tofile(f)
+
+        with logDuration("rasterizing OSM ways from PBF"):
+            with rasterizationExecutor() as executor:
+                inFlight = deque()
+                for batch in iterWayBatches(pbfFile, tagFilter, OSM_CHUNK_SIZE):
+                    # Rows of the batch stand in for way ids, so that they keep
+                    # order
+                    future = executor.submit(
+                        _rasterizeOSMWays,
+                        batch.coords,
+                        batch.offsets,
+                        np.arange(len(batch.wayIds), dtype=np.int64),
+                    )
+                    inFlight.append((batch, future))
+                    if len(inFlight) > 2 * OSM_WORKERS:
+                        collect(*inFlight.popleft())
+                while inFlight:
+                    collect(*inFlight.popleft())
+        for teryt in terytCodes:
+            for osmKey, osmValues in tagFilter.items():
+                cacheKeys = valueCacheKeys(osmKey, tuple(osmValues), teryt)
+                for value, key in cacheKeys.items():
+                    spoolFile = spoolFiles.pop((teryt, osmKey, value), None)
+                    if spoolFile is None:
+                        cells = np.empty(0, dtype=np.uint64)
+                    else:
+                        cells = np.unique(np.fromfile(spoolFile, dtype=np.uint64))
+                        spoolFile.unlink()
+                    # Way cells are kept for Overpass updates only, an extract
+                    # is read again as a whole
+                    writeCachedCoverage(
+                        key,
+                        dilateCoverage(makeCoverage(cells), cachedNeighbourhoodSize()),
+                        osmTimestamp,
+                        evict=False,
+                    )
+    evictCoverageCache()
+    logging.info(f"Cached OSM coverage of {len(terytCodes)} areas from {pbfFile}")
+
+
+pbfCoverageBuild: asyncio.Future | None = None
+
+
+async def getOSMDataFromPbf(theme: Theme, teryt: str) -> Coverage:
+    global pbfCoverageBuild
+    osmTimestamp = pbfTimestamp(OSM_PBF_FILE)
+    cacheKeys = valueCacheKeys(theme.osmKey, theme.osmValues, teryt)
+    coverages = {
+        value: readCachedCoverage(key, notBefore=osmTimestamp)
+        for value, key in cacheKeys.items()
+    }
+    if None in coverages.values():
+        # The first theme missing coverage builds it for all themes and areas
+        if pbfCoverageBuild is None:
+            pbfCoverageBuild = asyncio.ensure_future(
+                asyncio.to_thread(buildCoverageFromPbf, OSM_PBF_FILE, THEMES)
+            )
+        await asyncio.shield(pbfCoverageBuild)
+        coverages = {
+            value: readCachedCoverage(key, notBefore=osmTimestamp)
+            for value, key in cacheKeys.items()
+        }
+    if None in coverages.values():
+        raise RuntimeError(
+            f"No OSM coverage of {teryt} in {OSM_PBF_FILE}, it is not a powiat "
+            f"boundary in the extract or COVERAGE_CACHE_MAX_SIZE is too small"
+        )
+    return unionCoverages(list(coverages.values()))
+
+
+def outputPath(theme: Theme, teryt: str) -> Path:
+    return missingDir / f"{theme.name}-{teryt}.{WRITERS[OUTPUT_FORMAT].extension}"
+
+
+def fingerprint(value) -> str:
+    return hashlib.sha256(json.dumps(value, sort_keys=True).encode()).hexdigest()
+
+
+def parametersFingerprint(theme: Theme) -> str:
+    return fingerprint(
+        dict(
+            theme=asdict(theme),
+            overpassWayQuery=theme.overpassWayQuery,
+            bdotMetadataColumns=BDOT_METADATA_COLUMNS,
+            resolution=H3_RESOLUTION,
+            coarseResolution=H3_COARSE_RESOLUTION,
+            sampleStepRatio=H3_SAMPLE_STEP_RATIO,
+            neighbourhoodSize=OSM_NEIGHBOURHOOD_SIZE,
+            version=COVERAGE_ALGORITHM_VERSION,
+        )
+    )
+
+
+def coverageFingerprint(coverage: Coverage) -> str:
+    digest = hashlib.sha256(coverage.cells.toCells().data)
+    digest.update(str(coverage.neighbourhoodSize).encode())
+    return digest.hexdigest()
+
+
+def fileFingerprint(path: Path) -> str:
+    # Hashes are remembered in the manifest while size and mtime stay the same
+    stat = path.stat()
+    fileKey = dict(size=stat.st_size, mtime=stat.st_mtime_ns)
+    with lockManifest():
+        known = readManifest()["files"].get(str(path))
+    if known is not None and known["stat"] == fileKey:
+        return known["sha256"]
+    digest = hashlib.sha256()
+    with path.open("rb") as f:
+        while chunk := f.read(1024**2):
+            digest.update(chunk)
+    with lockManifest():
+        manifest = readManifest()
+        manifest["files"][str(path)] = dict(stat=fileKey, sha256=digest.hexdigest())
+        writeManifest(manifest)
+    return digest.hexdigest()
+
+
+def bdotFingerprint(theme: Theme, teryt: str) -> str:
+    path = bdotLayerPath(theme, teryt)
+    if READ_BDOT_FROM_ARCHIVE:
+        # CRC of the archive member is a content fingerprint available for free
+        archivePath = bdotArchivePath(teryt)
+        member = path.removeprefix(f"/vsizip/{archivePath}/")
+        with zipfile.ZipFile(archivePath) as archive:
+            info = archive.getinfo(member)
+        return f"crc32:{info.CRC:08x}:{info.file_size}"
+    return fileFingerprint(Path(path))
+
+
+def outputInputs(theme: Theme, teryt: str, osmCoverage: Coverage) -> dict[str, str]:
+    return dict(
+        parameters=parametersFingerprint(theme),
+        bdot=bdotFingerprint(theme, teryt),
+        osm=coverageFingerprint(osmCoverage),
+    )
+
+
+@contextmanager
+def fileLock(path: Path):
+    """Exclusive lock shared with other processes."""
+    with path.open("a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        yield
+
+
+@asynccontextmanager
+async def asyncFileLock(path: Path):
+    with path.open("a") as f:
+        await asyncio.to_thread(fcntl.flock, f, fcntl.LOCK_EX)
+        yield
+
+
+manifestPath = missingDir / "manifest.json"
+manifestLock = threading.Lock()
+
+
+@contextmanager
+def lockManifest():
+    # Worker processes of the job runner share the manifest
+    with manifestLock, fileLock(manifestPath.with_name("manifest.lock")):
+        yield
+
+
+def readManifest() -> dict:
+    """Fingerprints of the inputs of every output and hashes of input files."""
+    try:
+        with manifestPath.open() as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return dict(outputs={}, files={})
+
+
+def writeManifest(manifest: dict):
+    partialPath = manifestPath.with_name(f"{manifestPath.name}.part")
+    with partialPath.open("w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    partialPath.replace(manifestPath)
+
+
+def outputMayBeFresh(theme: Theme, teryt: str) -> bool:
+    """Whether the output exists and was made with the current parameters."""
+    outputFile = outputPath(theme, teryt)
+    with lockManifest():
+        inputs = readManifest()["outputs"].get(outputFile.name)
+    return (
+        outputFile.exists()
+        and inputs is not None
+        and inputs["parameters"] == parametersFingerprint(theme)
+    )
+
+
+def isOutputFresh(theme: Theme, teryt: str, osmCoverage: Coverage) -> bool:
+    outputFile = outputPath(theme, teryt)
+    with lockManifest():
+        inputs = readManifest()["outputs"].get(outputFile.name)
+    return outputFile.exists() and inputs == outputInputs(theme, teryt, osmCoverage)
+
+
+def recordOutput(theme: Theme, teryt: str, inputs: dict[str, str]):
+    with lockManifest():
+        manifest = readManifest()
+        manifest["outputs"][outputPath(theme, teryt).name] = inputs
+        writeManifest(manifest)
+
+
+def readStaleBdotLines(
+    theme: Theme, teryt: str, osmCoverage: Coverage
+) -> BdotLines | None:
+    """BDOT lines of the theme, None if its output is up to date."""
+    if isOutputFresh(theme, teryt, osmCoverage):
+        logging.info(f"{outputPath(theme, teryt)} is up to date")
+        return None
+    return readBdotLines(theme, teryt)
+
+
+def writeMissingFeatures(osmCoverage: Coverage, bdotLines: BdotLines, outputFile: Path):
+    # Written next to the output and renamed, so that an interrupted run never
+    # leaves a truncated output behind. The extension stays last, GDAL picks
+    # the file layout by it.
+    partialFile = outputFile.with_name(f"{outputFile.stem}.part{outputFile.suffix}")
+    try:
+        with logDuration("comparing BDOT features with OSM and writing missing ones"):
+            with WRITERS[OUTPUT_FORMAT](partialFile) as writer:
+                start = 0
+                for missing in iterMissingLines(
+                    bdotLines.coords,
+                    bdotLines.offsets,
+                    osmCoverage,
+                    neighbourhood_size=OSM_NEIGHBOURHOOD_SIZE,
+                ):
+                    fids = bdotLines.fids[start : start + len(missing)][missing]
+                    start += len(missing)
+                    if len(fids) > 0:
+                        writer.write(readBdotFeatures(bdotLines, fids))
+        partialFile.replace(outputFile)
+    finally:
+        partialFile.unlink(missing_ok=True)
+
+
+def updateOutput(
+    theme: Theme, teryt: str, osmCoverage: Coverage, bdotLines: BdotLines | None
+):
+    if bdotLines is None:
+        return
+    inputs = outputInputs(theme, teryt, osmCoverage)
+    writeMissingFeatures(osmCoverage, bdotLines, outputPath(theme, teryt))
+    recordOutput(theme, teryt, inputs)
+
+
+async def processTheme(
+    theme: Theme,
+    teryt: str,
+    overpass: OverpassClient,
+    compareLimit: asyncio.Semaphore | None = None,
+):
+    if outputMayBeFresh(theme, teryt):
+        # BDOT data is read only if it or OSM data changed
+        osmCoverage = await getOSMData(theme, teryt, overpass)
+        bdotLines = await asyncio.to_thread(
+            readStaleBdotLines, theme, teryt, osmCoverage
+        )
+    else:
+        [osmCoverage, bdotLines] = await asyncio.gather(
+            getOSMData(theme, teryt, overpass), getBdotData(theme, teryt)
+        )
+    async with compareLimit or nullcontext():
+        await asyncio.to_thread(updateOutput, theme, teryt, osmCoverage, bdotLines)
+
+
+def scheduleTheme(
+    scheduler: Scheduler,
+    theme: Theme,
+    teryt: str,
+    overpass: OverpassClient,
+    download: Task,
+):
+    osmCoverage = scheduler.add(
+        f"osm {theme.name} {teryt}",
+        getOSMData,
+        theme,
+        teryt,
+        overpass,
+        resource="overpass",
+    )
+    if outputMayBeFresh(theme, teryt):
+        # BDOT data is read only if it or OSM data changed
+        bdotLines = scheduler.add(
+            f"bdot {theme.name} {teryt}",
+            readStaleBdotLines,
+            theme,
+            teryt,
+            osmCoverage,
+            after=[download],
+            resource="bdot",
+        )
+    else:
+        bdotLines = scheduler.add(
+            f"bdot {theme.name} {teryt}",
+            getBdotData,
+            theme,
+            teryt,
+            after=[download],
+            resource="bdot",
+        )
+    scheduler.add(
+        f"compare {theme.name} {teryt}",
+        updateOutput,
+        theme,
+        teryt,
+        osmCoverage,
+        bdotLines,
+        resource="compare",
+    )
+
+
+def bdotLayerMembers(archive: zipfile.ZipFile, teryt: str) -> list[zipfile.ZipInfo]:
+    suffixes = tuple(bdotLayerFileSuffix(theme, teryt) for theme in THEMES)
+    return [info for info in archive.infolist() if info.filename.endswith(suffixes)]
+
+
+def bdotLayersExtracted(teryt: str) -> bool:
+    return all(
+        any(bdotDataDir.glob(f"*{bdotLayerFileSuffix(theme, teryt)}"))
+        for theme in THEMES
+    )
+
+
+def bdotUrl(teryt: str) -> str:
+    return f"{BDOT_URL}/{teryt[:2]}/{teryt}_GPKG.zip"
+
+
+async def downloadBdot(teryt: str, downloader: Downloader):
+    # Worker processes of the job runner may need the same archive at once
+    async with asyncFileLock(bdotDataDir / f"{teryt}.lock"):
+        url = bdotUrl(teryt)
+        file = bdotArchivePath(teryt)
+        if not READ_BDOT_FROM_ARCHIVE and bdotLayersExtracted(teryt):
+            logging.info(f"BDOT layers for {teryt} already extracted")
+            return
+        if not file.exists():
+            logging.info(f"Downloading {url}")
+            await downloader.download(url, file)
+        else:
+            logging.info(f"File {file} already exists")
+        if READ_BDOT_FROM_ARCHIVE:
+            return
+        await asyncio.to_thread(extractBdotLayers, teryt, file)
+
+
+def extractBdotLayers(teryt: str, file: Path):
+    with zipfile.ZipFile(file) as z:
+        for member in bdotLayerMembers(z, teryt):
+            # Renamed once complete, a layer interrupted mid-extraction is not
+            # mistaken for an extracted one
+            layerPath = bdotDataDir / member.filename
+            layerPath.parent.mkdir(parents=True, exist_ok=True)
+            partialPath = layerPath.with_suffix(".part")
+            with z.open(member) as source, partialPath.open("wb") as f:
+                shutil.copyfileobj(source, f)
+            partialPath.rename(layerPath)
+    if not KEEP_BDOT_ARCHIVES:
+        file.unlink()
+
+
+def bdotClients() -> tuple[Downloader, OverpassClient]:
+    return (
+        Downloader(
+            concurrency=BDOT_DOWNLOAD_CONCURRENCY,
+            connectionsPerHost=BDOT_CONNECTIONS_PER_HOST,
+        ),
+        OverpassClient(OVERPASS_URL, OVERPASS_CONCURRENCY),
+    )
+
+
+def writeIndex(terytNames: dict[str, str]):
     with Path("index.html").open("w") as f:
-        for name, teryt in terytCodes.items():
+        for teryt, name in terytNames.items():
             for theme in THEMES:
-                outputFile = missingDir / f"{theme.name}-{teryt}.geojson"
-                f.write(f"<a href='./{outputFile}' download>{name} {theme.name}</a><br/>\n")
+                outputFile = outputPath(theme, teryt)
+                f.write(
+                    f"<a href='./{outputFile}' download>{name or teryt} {theme.name}"
+                    f"</a><br/>\n"
+                )
+
+
+async def processCities():
+    # Overpass queries and downloads are limited by their clients
+    scheduler = Scheduler(dict(bdot=BDOT_READ_CONCURRENCY, compare=COMPARE_CONCURRENCY))
+    downloader, overpass = bdotClients()
+    async with downloader, overpass:
+        for teryt in CITIES.values():
+            download = scheduler.add(
+                f"download {teryt}",
+                downloadBdot,
+                teryt,
+                downloader,
+                resource="download",
+            )
+            for theme in THEMES:
+                scheduleTheme(scheduler, theme, teryt, overpass, download)
+        await scheduler.run()
+    scheduler.logTimings()
+    writeIndex({teryt: name for name, teryt in CITIES.items()})
+
+
+async def getPowiats(overpass: OverpassClient) -> dict[str, str]:
+    query = f"""
+    [out:json][timeout:{POWIATS_QUERY_TIMEOUT}];
+    area["ISO3166-1"="PL"][admin_level=2]->.poland;
+    relation["boundary"="administrative"]["admin_level"="6"]["teryt:terc"](area.poland);
+    out tags;
+    """
+    response = await overpass.post(
+        query, timeout=POWIATS_QUERY_TIMEOUT + OVERPASS_TIMEOUT_MARGIN
+    )
+    return {
+        element["tags"]["teryt:terc"]: element["tags"].get("name", "")
+        for element in response.json()["elements"]
+    }
+
+
+async def bdotDataSize(teryt: str, downloader: Downloader) -> int:
+    archive = bdotArchivePath(teryt)
+    if archive.exists():
+        return archive.stat().st_size
+    layers = list(bdotDataDir.glob(f"*.BDOT10k.{teryt}__*.gpkg"))
+    if layers:
+        return sum(layer.stat().st_size for layer in layers)
+    return await downloader.contentLength(bdotUrl(teryt)) or 0
+
+
+async def seedJobs(queue: JobQueue, terytNames: dict[str, str] | None = None):
+    """Queues every theme of the powiats, all of them by default.
+
+    Powiats with most BDOT data go first, so that they do not finish last.
+    """
+    downloader, overpass = bdotClients()
+    async with downloader, overpass:
+        if terytNames is None:
+            terytNames = await getPowiats(overpass)
+        sizes = await asyncio.gather(
+            *(bdotDataSize(teryt, downloader) for teryt in terytNames)
+        )
+    queue.add(
+        [
+            Job(teryt=teryt, theme=theme.name, name=name, priority=size)
+            for (teryt, name), size in zip(terytNames.items(), sizes)
+            for theme in THEMES
+        ]
+    )
+    logging.info(f"Queued {len(terytNames)} powiats, {len(THEMES)} themes each")
+
+
+async def runJob(
+    job: Job,
+    downloader: Downloader,
+    overpass: OverpassClient,
+    compareLimit: asyncio.Semaphore,
+):
+    [theme] = [theme for theme in THEMES if theme.name == job.theme]
+    await downloadBdot(job.teryt, downloader)
+    await processTheme(theme, job.teryt, overpass, compareLimit)
+
+
+async def workJobs(queue: JobQueue, concurrency: int = JOB_CONCURRENCY):
+    """Runs queued jobs until none is left, a failed job does not stop others."""
+    running = set()
+    # Each comparison uses BDOT_WORKERS processes
+    compareLimit = asyncio.Semaphore(COMPARE_CONCURRENCY)
+
+    async def heartbeat():
+        while True:
+            await asyncio.sleep(queue.lease / 3)
+            queue.heartbeat(list(running))
+
+    async def worker():
+        while (job := queue.claim()) is not None:
+            logging.info(f"Running {job.theme} {job.teryt} {job.name}")
+            running.add(job)
+            try:
+                await runJob(job, downloader, overpass, compareLimit)
+            except Exception as e:
+                logging.exception(f"{job.theme} {job.teryt} failed")
+                queue.fail(job, repr(e))
+            except BaseException:
+                queue.release(job)
+                raise
+            else:
+                queue.finish(job)
+            finally:
+                running.discard(job)
+
+    downloader, overpass = bdotClients()
+    async with downloader, overpass:
+        heartbeatTask = asyncio.create_task(heartbeat())
+        try:
+            await asyncio.gather(*(worker() for _ in range(concurrency)))
+        finally:
+            heartbeatTask.cancel()
+
+
+def logJobStatus(queue: JobQueue):
+    counts = queue.counts()
+    logging.info(", ".join(f"{count} {status}" for status, count in counts.items()))
+    for job, error in queue.failures():
+        logging.info(f"  {job.theme} {job.teryt} {job.name}: {error}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.add_parser("run", help="process CITIES in one go")
+    seed = subparsers.add_parser("seed", help="queue jobs of powiats and themes")
+    seed.add_argument("--jobs", type=Path, default=JOBS_FILE)
+    seed.add_argument("--teryt", nargs="+", help="powiats to queue instead of all")
+    seed.add_argument("--retry-failed", action="store_true")
+    work = subparsers.add_parser(
+        "work", help="run queued jobs, any number of workers may share them"
+    )
+    work.add_argument("--jobs", type=Path, default=JOBS_FILE)
+    work.add_argument("--concurrency", type=int, default=JOB_CONCURRENCY)
+    status = subparsers.add_parser("status", help="show job counts and failures")
+    status.add_argument("--jobs", type=Path, default=JOBS_FILE)
+    args = parser.parse_args()
+
+    if args.command in (None, "run"):
+        asyncio.run(processCities())
+        return
+    with JobQueue(args.jobs) as queue:
+        if args.command == "seed":
+            terytNames = dict.fromkeys(args.teryt, "") if args.teryt else None
+            asyncio.run(seedJobs(queue, terytNames))
+            if args.retry_failed:
+                queue.retryFailed()
+        elif args.command == "work":
+            asyncio.run(workJobs(queue, args.concurrency))
+            writeIndex({job.teryt: job.name for job in queue.jobs()})
+        logJobStatus(queue)
 
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO, format="%(message)s")
-    asyncio.run(main())
+    main()
@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Callable
+
+import numpy as np
+
+import bdot
+
+WARSZAWA = (21.01, 52.23)
+# Peak memory differences below this are noise
+MEMORY_NOISE = 1024**2
+
+
+@dataclass(frozen=True)
+class BenchmarkResult:
+    name: str
+    seconds: float
+    segments: int
+    cells: int
+    peakMemory: int
+
+    @property
+    def segmentsPerSecond(self) -> float:
+        return self.segments / self.seconds
+
+    @property
+    def cellsPerSecond(self) -> float:
+        return self.cells / self.seconds
+
+
+def syntheticLines(
+    count: int,
+    segments: int = 5,
+    segmentLength: float = 50.0,
+    extent: float = 0.2,
+    seed: int = 0,
+) -> tuple[np.ndarray, np.ndarray]:
+    rng = np.random.default_rng(seed)
+    metresPerDegree = np.radians(1) * bdot.EARTH_RADIUS_M
+    starts = np.array(WARSZAWA) + rng.uniform(-extent / 2, extent / 2, (count, 2))
+    angles = rng.uniform(0, 2 * np.pi, (count, segments))
+    steps = np.stack([np.cos(angles), np.sin(angles)], axis=-1)
+    steps *= segmentLength / metresPerDegree
+    steps[..., 0] /= np.cos(np.radians(WARSZAWA[1]))
+    lines = np.concatenate(
+        [starts[:, np.newaxis], starts[:, np.newaxis] + np.cumsum(steps, axis=1)],
+        axis=1,
+    )
+    offsets = np.arange(count + 1, dtype=np.int64) * (segments + 1)
+    return lines.reshape(-1, 2), offsets
+
+
+def syntheticOSMData(coords: np.ndarray, offsets: np.ndarray) -> list[dict]:
+    return [
+        dict(geometry=dict(type="LineString", coordinates=coords[start:end].tolist()))
+        for start, end in zip(offsets[:-1], offsets[1:])
+    ]
+
+
+def measure(
+    name: str, function: Callable[[], int], segments: int, repeat: int
+) -> BenchmarkResult:
+    best = None
+    for _ in range(repeat):
+        tracemalloc.start()
+        start = time.perf_counter()
+        cells = function()
+        seconds = time.perf_counter() - start
+        _, peakMemory = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        result = BenchmarkResult(name, seconds, segments, cells, peakMemory)
+        if best is None or result.seconds < best.seconds:
+            best = result
+    return best
+
+
+def runBenchmarks(args) -> list[BenchmarkResult]:
+    segmentCount = args.lines * args.segments
+    osmCoords, osmOffsets = syntheticLines(
+        args.lines, args.segments, args.segment_length, seed=1
+    )
+    bdotCoords, bdotOffsets = syntheticLines(
+        args.lines, args.segments, args.segment_length, seed=2
+    )
+    osmData = syntheticOSMData(osmCoords, osmOffsets)
+    osmLines = [element["geometry"]["coordinates"] for element in osmData]
+    coverage = bdot.makeCoverage(bdot.rasterizeLines(osmCoords, osmOffsets))
+    bdotCellCount = len(bdot.rasterizeLines(bdotCoords, bdotOffsets))
+    legacyLines = osmLines[: max(1, len(osmLines) // args.legacy_fraction)]
+
+    def h3LineLatLng() -> int:
+        cells = set()
+        for line in legacyLines:
+            for start, end in zip(line[:-1], line[1:]):
+                cells |= bdot.h3LineLatLng(start, end)
+        return len(cells)
+
+    def processLineIntoH3Set() -> int:
+        return sum(len(bdot.processLineIntoH3Set(line)) for line in osmLines)
+
+    def processOSMDataIntoH3Set() -> int:
+        return len(bdot.processOSMDataIntoH3Set(osmData, neighbourhood_size=0))
+
+    def compare(workers: int) -> Callable[[], int]:
+        def run() -> int:
+            bdot.findMissingLinesParallel(
+                bdotCoords,
+                bdotOffsets,
+                coverage,
+                neighbourhood_size=bdot.OSM_NEIGHBOURHOOD_SIZE,
+                workers=workers,
+            )
+            return bdotCellCount
+
+        return run
+
+    benchmarks = [
+        (
+            "h3LineLatLng",
+            h3LineLatLng,
+            sum(len(line) - 1 for line in legacyLines),
+        ),
+        ("processLineIntoH3Set", processLineIntoH3Set, segmentCount),
+        ("processOSMDataIntoH3Set", processOSMDataIntoH3Set, segmentCount),
+        ("compare", compare(1), segmentCount),
+    ]
+    if args.workers > 1:
+        benchmarks.append(
+            (f"compare[{args.workers}]", compare(args.workers), segmentCount)
+        )
+    results = []
+    for name, function, segments in benchmarks:
+        result = measure(name, function, segments, args.repeat)
+        print(
+            f"{name:28} {result.seconds:8.3f}s "
+            f"{result.segmentsPerSecond:12,.0f} segments/s "
+            f"{result.cellsPerSecond:12,.0f} cells/s "
+            f"{result.peakMemory / 1024**2:8.1f}MB peak"
+        )
+        results.append(result)
+    return results
+
+
+def findRegressions(
+    results: list[BenchmarkResult], baselineFile: Path, tolerance: float
+) -> list[str]:
+    with baselineFile.open() as f:
+        baseline = {result["name"]: result for result in json.load(f)}
+    regressions = []
+    for result in results:
+        if result.name not in baseline:
+            continue
+        previous = baseline[result.name]
+        if result.seconds > previous["seconds"] * (1 + tolerance):
+            regressions.append(
+                f"{result.name}: {previous['seconds']:.3f}s -> {result.seconds:.3f}s"
+            )
+        if (
+            result.peakMemory > previous["peakMemory"] * (1 + tolerance)
+            and result.peakMemory - previous["peakMemory"] > MEMORY_NOISE
+        ):
+            regressions.append(
+                f"{result.name}: {previous['peakMemory'] / 1024**2:.1f}MB"
+                f" -> {result.peakMemory / 1024**2:.1f}MB peak"
+            )
+    return regressions
+
+
+def benchmarkScaling(features: int, osmLines: int, maxWorkers: int):
+    coverage = bdot.makeCoverage(bdot.rasterizeLines(*syntheticLines(osmLines, seed=1)))
+    coords, offsets = syntheticLines(features, seed=2)
+    print(f"{features} BDOT features, {len(coverage.cells)} OSM cells")
+    workerCounts = [1]
+    while workerCounts[-1] * 2 <= maxWorkers:
+        workerCounts.append(workerCounts[-1] * 2)
+    if workerCounts[-1] != maxWorkers:
+        workerCounts.append(maxWorkers)
+    baseline = None
+    for workers in workerCounts:
+        start = time.perf_counter()
+        bdot.findMissingLinesParallel(
+            coords,
+            offsets,
+            coverage,
+            neighbourhood_size=bdot.OSM_NEIGHBOURHOOD_SIZE,
+            workers=workers,
+        )
+        duration = time.perf_counter() - start
+        baseline = baseline or duration
+        print(
+            f"workers={workers:3} {duration:8.2f}s speedup={baseline / duration:5.2f}x"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command")
+    run = subparsers.add_parser("run", help="hot path benchmarks")
+    run.add_argument("--lines", type=int, default=20_000)
+    run.add_argument("--segments", type=int, default=5)
+    run.add_argument("--segment-length", type=float, default=50.0)
+    run.add_argument("--repeat", type=int, default=3)
+    run.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    run.add_argument(
+        "--legacy-fraction",
+        type=int,
+        default=20,
+        help="run recursive h3LineLatLng only on 1/N of the lines",
+    )
+    run.add_argument("--output", type=Path, help="write results as JSON")
+    run.add_argument("--baseline", type=Path, help="compare with earlier JSON results")
+    run.add_argument("--tolerance", type=float, default=0.2)
+    scaling = subparsers.add_parser(
+        "scaling", help="worker scaling curve of the compare stage"
+    )
+    scaling.add_argument("--features", type=int, default=200_000)
+    scaling.add_argument("--osm-lines", type=int, default=50_000)
+    scaling.add_argument("--max-workers", type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+
+    if args.command == "scaling":
+        benchmarkScaling(args.features, args.osm_lines, args.max_workers)
+        return
+    if args.command is None:
+        args = run.parse_args([])
+    results = runBenchmarks(args)
+    if args.output:
+        with args.output.open("w") as f:
+            json.dump([asdict(result) for result in results], f, indent=2)
+    if args.baseline:
+        regressions = findRegressions(results, args.baseline, args.tolerance)
+        for regression in regressions:
+            print(f"Regression {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
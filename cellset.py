@@ -0,0 +1,175 @@
+from dataclasses import dataclass
+from pathlib import Path
+
+import numpy as np
+
+# H3 index digits below the container key, 3 bits each
+LOW_DIGITS = 5
+LOW_BITS = 3 * LOW_DIGITS
+BITMAP_BYTES = 2**LOW_BITS // 8
+# Containers with more cells are bitmaps, they take as many bytes as this many
+# uint16 entries
+ARRAY_LIMIT = BITMAP_BYTES // 2
+FIELDS = ("keys", "offsets", "lows", "bitmapIndex", "bitmaps")
+
+
+def unionSortedCells(parts: list[np.ndarray]) -> np.ndarray:
+    if not parts:
+        return np.empty(0, dtype=np.uint64)
+    # Stable sort is a timsort which merges the already sorted runs
+    cells = np.sort(np.concatenate(parts), kind="stable")
+    keep = np.ones(len(cells), dtype=bool)
+    keep[1:] = cells[1:] != cells[:-1]
+    return cells[keep]
+
+
+@dataclass(frozen=True)
+class CellSet:
+    """Compact set of H3 cells of one resolution, in the style of roaring bitmaps.
+
+    Cells are grouped by their parent LOW_DIGITS resolutions up. Children of a
+    parent are stored as a sorted uint16 array, or a bitmap once there are more
+    than ARRAY_LIMIT of them. Container of keys[i] is a bitmap
+    bitmaps[bitmapIndex[i]] or, when bitmapIndex[i] is -1, the array
+    lows[offsets[i]:offsets[i + 1]].
+    """
+
+    resolution: int
+    keys: np.ndarray
+    offsets: np.ndarray
+    lows: np.ndarray
+    bitmapIndex: np.ndarray
+    bitmaps: np.ndarray
+
+    @property
+    def lowShift(self) -> int:
+        return 3 * (15 - self.resolution)
+
+    @property
+    def keyShift(self) -> int:
+        return self.lowShift + LOW_BITS
+
+    @property
+    def nbytes(self) -> int:
+        return sum(array.nbytes for array in self.arrays().values())
+
+    def arrays(self) -> dict[str, np.ndarray]:
+        return {field: getattr(self, field) for field in FIELDS}
+
+    def __len__(self) -> int:
+        return len(self.lows) + int(np.unpackbits(self.bitmaps).sum())
+
+    @classmethod
+    def fromCells(cls, cells: np.ndarray, resolution: int) -> "CellSet":
+        """Builds the set from sorted unique cells of the resolution."""
+        lowShift = 3 * (15 - resolution)
+        cells = np.asarray(cells, dtype=np.uint64)
+        cellKeys = cells >> np.uint64(lowShift + LOW_BITS)
+        cellLows = (
+            (cells >> np.uint64(lowShift)) & np.uint64(2**LOW_BITS - 1)
+        ).astype(np.uint16)
+        keys, counts = np.unique(cellKeys, return_counts=True)
+        isBitmap = counts > ARRAY_LIMIT
+        inBitmap = np.repeat(isBitmap, counts)
+        offsets = np.zeros(len(keys) + 1, dtype=np.int64)
+        np.cumsum(np.where(isBitmap, 0, counts), out=offsets[1:])
+        bitmapIndex = np.full(len(keys), -1, dtype=np.int32)
+        bitmapIndex[isBitmap] = np.arange(isBitmap.sum(), dtype=np.int32)
+        bits = np.zeros((isBitmap.sum(), 2**LOW_BITS), dtype=bool)
+        bits[np.repeat(bitmapIndex[isBitmap], counts[isBitmap]), cellLows[inBitmap]] = (
+            True
+        )
+        return cls(
+            resolution=resolution,
+            keys=keys,
+            offsets=offsets,
+            lows=cellLows[~inBitmap],
+            bitmapIndex=bitmapIndex,
+            bitmaps=np.packbits(bits, axis=1, bitorder="little"),
+        )
+
+    def toCells(self) -> np.ndarray:
+        """Sorted cells of the set."""
+        arrayCells = self.cellsOf(
+            np.repeat(self.keys, np.diff(self.offsets)), self.lows
+        )
+        bits = np.unpackbits(self.bitmaps, axis=1, bitorder="little")
+        rows, bitmapLows = np.nonzero(bits)
+        bitmapKeys = self.keys[self.bitmapIndex >= 0]
+        bitmapCells = self.cellsOf(bitmapKeys[rows], bitmapLows)
+        # Both parts are sorted, a stable sort merges them
+        return np.sort(np.concatenate([arrayCells, bitmapCells]), kind="stable")
+
+    def cellsOf(self, keys: np.ndarray, lows: np.ndarray) -> np.ndarray:
+        # Unused digits of H3 indexes are all ones
+        return (
+            (keys.astype(np.uint64) << np.uint64(self.keyShift))
+            | (lows.astype(np.uint64) << np.uint64(self.lowShift))
+            | np.uint64(2**self.lowShift - 1)
+        )
+
+    def contains(self, cells: np.ndarray) -> np.ndarray:
+        cells = np.asarray(cells, dtype=np.uint64)
+        result = np.zeros(len(cells), dtype=bool)
+        if len(self.keys) == 0 or len(cells) == 0:
+            return result
+        cellKeys = cells >> np.uint64(self.keyShift)
+        cellLows = (cells >> np.uint64(self.lowShift)) & np.uint64(2**LOW_BITS - 1)
+        container = np.minimum(np.searchsorted(self.keys, cellKeys), len(self.keys) - 1)
+        found = (self.keys[container] == cellKeys) & (
+            cells & np.uint64(2**self.lowShift - 1) == np.uint64(2**self.lowShift - 1)
+        )
+        bitmap = self.bitmapIndex[container]
+        inBitmap = np.flatnonzero(found & (bitmap >= 0))
+        lows = cellLows[inBitmap].astype(np.int64)
+        result[inBitmap] = (
+            self.bitmaps[bitmap[inBitmap], lows >> 3] >> (lows & 7).astype(np.uint8)
+        ) & 1 == 1
+        inArray = np.flatnonzero(found & (bitmap < 0))
+        result[inArray] = self.arrayContains(
+            container[inArray], cellLows[inArray].astype(np.uint16)
+        )
+        return result
+
+    def arrayContains(self, containers: np.ndarray, lows: np.ndarray) -> np.ndarray:
+        # Binary search of all lows at once, each within its own container
+        if len(self.lows) == 0:
+            return np.zeros(len(lows), dtype=bool)
+        start = self.offsets[containers]
+        end = self.offsets[containers + 1]
+        low, high = start.copy(), end.copy()
+        for _ in range(int(np.log2(ARRAY_LIMIT)) + 1):
+            middle = (low + high) // 2
+            less = (low < high) & (
+                self.lows[np.minimum(middle, len(self.lows) - 1)] < lows
+            )
+            low = np.where(less, middle + 1, low)
+            high = np.where(less | (low >= high), high, middle)
+        return (low < end) & (self.lows[np.minimum(low, len(self.lows) - 1)] == lows)
+
+    def union(self, *others: "CellSet") -> "CellSet":
+        return CellSet.fromCells(
+            unionSortedCells([self.toCells()] + [other.toCells() for other in others]),
+            self.resolution,
+        )
+
+    def intersection(self, other: "CellSet") -> "CellSet":
+        cells = self.toCells()
+        return CellSet.fromCells(cells[other.contains(cells)], self.resolution)
+
+    def save(self, directory: Path, name: str):
+        """Writes the set as .npy files, which load() can memory-map."""
+        np.save(directory / f"{name}.resolution.npy", np.int64(self.resolution))
+        for field, array in self.arrays().items():
+            np.save(directory / f"{name}.{field}.npy", array)
+
+    @classmethod
+    def load(cls, directory: Path, name: str, mmap: bool = False) -> "CellSet":
+        mmapMode = "r" if mmap else None
+        return cls(
+            resolution=int(np.load(directory / f"{name}.resolution.npy")),
+            **{
+                field: np.load(directory / f"{name}.{field}.npy", mmap_mode=mmapMode)
+                for field in FIELDS
+            },
+        )
@@ -0,0 +1,102 @@
+import asyncio
+import logging
+import time
+from collections import defaultdict
+from pathlib import Path
+
+from httpx import AsyncClient, HTTPStatusError, Limits, TransportError, URL
+from starsep_utils import formatFileSize
+
+DEFAULT_CONCURRENCY = 8
+DEFAULT_CONNECTIONS_PER_HOST = 4
+DEFAULT_RETRIES = 5
+DEFAULT_BACKOFF = 1.0
+DEFAULT_CHUNK_SIZE = 1024**2
+
+
+def isRetryable(error: Exception) -> bool:
+    if isinstance(error, HTTPStatusError):
+        status = error.response.status_code
+        return status == 429 or status >= 500
+    return isinstance(error, TransportError)
+
+
+class Downloader:
+    def __init__(
+        self,
+        concurrency: int = DEFAULT_CONCURRENCY,
+        connectionsPerHost: int = DEFAULT_CONNECTIONS_PER_HOST,
+        retries: int = DEFAULT_RETRIES,
+        backoff: float = DEFAULT_BACKOFF,
+        chunkSize: int = DEFAULT_CHUNK_SIZE,
+        timeout: float = 60.0,
+    ):
+        self.client = AsyncClient(
+            limits=Limits(max_connections=concurrency),
+            timeout=timeout,
+            follow_redirects=True,
+        )
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.hostSemaphores = defaultdict(lambda: asyncio.Semaphore(connectionsPerHost))
+        self.retries = retries
+        self.backoff = backoff
+        self.chunkSize = chunkSize
+        self.bytesDownloaded = 0
+        self.filesDownloaded = 0
+        self.startTime = time.perf_counter()
+
+    async def __aenter__(self) -> "Downloader":
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.client.aclose()
+        if self.filesDownloaded:
+            self.logThroughput()
+
+    @property
+    def throughput(self) -> float:
+        return self.bytesDownloaded / (time.perf_counter() - self.startTime)
+
+    def logThroughput(self):
+        logging.info(
+            f"Downloaded {self.filesDownloaded} files, "
+            f"{formatFileSize(self.bytesDownloaded, precision=1)} "
+            f"at {formatFileSize(int(self.throughput), precision=1)}/s"
+        )
+
+    async def contentLength(self, url: str) -> int | None:
+        async with self.semaphore, self.hostSemaphores[URL(url).host]:
+            try:
+                response = await self.client.head(url)
+                response.raise_for_status()
+            except (HTTPStatusError, TransportError) as e:
+                logging.warning(f"Cannot get size of {url}: {e!r}")
+                return None
+        try:
+            return int(response.headers["Content-Length"])
+        except (KeyError, ValueError):
+            return None
+
+    async def download(self, url: str, path: Path):
+        async with self.semaphore, self.hostSemaphores[URL(url).host]:
+            for attempt in range(self.retries + 1):
+                try:
+                    await self._download(url, path)
+                    self.filesDownloaded += 1
+                    return
+                except Exception as e:
+                    if attempt == self.retries or not isRetryable(e):
+                        raise
+                    delay = self.backoff * 2**attempt
+                    logging.warning(f"Retrying {url} in {delay:.0f}s after {e!r}")
+                    await asyncio.sleep(delay)
+
+    async def _download(self, url: str, path: Path):
+        partialPath = path.with_suffix(".part")
+        async with self.client.stream("GET", url) as response:
+            response.raise_for_status()
+            with partialPath.open("wb") as f:
+                async for chunk in response.aiter_bytes(self.chunkSize):
+                    f.write(chunk)
+                    self.bytesDownloaded += len(chunk)
+        partialPath.rename(path)
@@ -0,0 +1,183 @@
+import os
+import socket
+import sqlite3
+import time
+from dataclasses import dataclass
+from pathlib import Path
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+# A running job whose worker sent no heartbeat for this long is claimed again
+DEFAULT_LEASE = 600.0
+DEFAULT_ATTEMPTS = 3
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    teryt TEXT NOT NULL,
+    theme TEXT NOT NULL,
+    name TEXT NOT NULL DEFAULT '',
+    priority INTEGER NOT NULL DEFAULT 0,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    worker TEXT,
+    heartbeat REAL,
+    error TEXT,
+    PRIMARY KEY (teryt, theme)
+)
+"""
+
+
+@dataclass(frozen=True)
+class Job:
+    teryt: str
+    theme: str
+    name: str = ""
+    priority: int = 0
+
+
+class JobQueue:
+    """Persistent (teryt, theme) job table shared by worker processes and hosts.
+
+    Jobs are claimed highest priority first. A worker which crashed stops
+    sending heartbeats and its jobs are claimed again once their lease expires.
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        lease: float = DEFAULT_LEASE,
+        attempts: int = DEFAULT_ATTEMPTS,
+    ):
+        # Transactions are opened explicitly, BEGIN IMMEDIATE serialises claims
+        self.connection = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(SCHEMA)
+        self.lease = lease
+        self.attempts = attempts
+        self.worker = f"{socket.gethostname()}:{os.getpid()}"
+
+    def __enter__(self) -> "JobQueue":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.connection.close()
+
+    def add(self, jobs: list[Job]):
+        """Adds new jobs, updates name and priority of known ones."""
+        with self.connection:
+            self.connection.execute("BEGIN IMMEDIATE")
+            self.connection.executemany(
+                "INSERT INTO jobs (teryt, theme, name, priority) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (teryt, theme) DO UPDATE "
+                "SET name = excluded.name, priority = excluded.priority",
+                [(job.teryt, job.theme, job.name, job.priority) for job in jobs],
+            )
+
+    def claim(self) -> Job | None:
+        now = time.time()
+        with self.connection:
+            self.connection.execute("BEGIN IMMEDIATE")
+            # A job which keeps killing its workers is not claimed again
+            self.connection.execute(
+                "UPDATE jobs SET status = ?, error = ? "
+                "WHERE status = ? AND heartbeat < ? AND attempts >= ?",
+                (
+                    FAILED,
+                    "Worker stopped sending heartbeats",
+                    RUNNING,
+                    now - self.lease,
+                    self.attempts,
+                ),
+            )
+            row = self.connection.execute(
+                "SELECT teryt, theme, name, priority FROM jobs "
+                "WHERE status = ? OR (status = ? AND heartbeat < ?) "
+                "ORDER BY priority DESC, teryt, theme LIMIT 1",
+                (PENDING, RUNNING, now - self.lease),
+            ).fetchone()
+            if row is None:
+                return None
+            job = Job(*row)
+            self.connection.execute(
+                "UPDATE jobs SET status = ?, worker = ?, heartbeat = ?, "
+                "attempts = attempts + 1 WHERE teryt = ? AND theme = ?",
+                (RUNNING, self.worker, now, job.teryt, job.theme),
+            )
+        return job
+
+    def heartbeat(self, jobs: list[Job]):
+        with self.connection:
+            self.connection.execute("BEGIN IMMEDIATE")
+            self.connection.executemany(
+                "UPDATE jobs SET heartbeat = ? "
+                "WHERE teryt = ? AND theme = ? AND worker = ?",
+                [(time.time(), job.teryt, job.theme, self.worker) for job in jobs],
+            )
+
+    def finish(self, job: Job):
+        with self.connection:
+            self.connection.execute("BEGIN IMMEDIATE")
+            self.connection.execute(
+                "UPDATE jobs SET status = ?, error = NULL "
+                "WHERE teryt = ? AND theme = ? AND worker = ?",
+                (DONE, job.teryt, job.theme, self.worker),
+            )
+
+    def release(self, job: Job):
+        """Returns an interrupted job to the queue without counting the attempt."""
+        with self.connection:
+            self.connection.execute("BEGIN IMMEDIATE")
+            self.connection.execute(
+                "UPDATE jobs SET status = ?, attempts = attempts - 1 "
+                "WHERE teryt = ? AND theme = ? AND worker = ?",
+                (PENDING, job.teryt, job.theme, self.worker),
+            )
+
+    def fail(self, job: Job, error: str):
+        """Marks the job failed, or pending again while it has attempts left."""
+        with self.connection:
+            self.connection.execute("BEGIN IMMEDIATE")
+            self.connection.execute(
+                "UPDATE jobs SET status = CASE WHEN attempts < ? THEN ? ELSE ? END, "
+                "error = ? WHERE teryt = ? AND theme = ? AND worker = ?",
+                (
+                    self.attempts,
+                    PENDING,
+                    FAILED,
+                    error,
+                    job.teryt,
+                    job.theme,
+                    self.worker,
+                ),
+            )
+
+    def retryFailed(self):
+        with self.connection:
+            self.connection.execute("BEGIN IMMEDIATE")
+            self.connection.execute(
+                "UPDATE jobs SET status = ?, attempts = 0 WHERE status = ?",
+                (PENDING, FAILED),
+            )
+
+    def counts(self) -> dict[str, int]:
+        return dict(
+            self.connection.execute(
+                "SELECT status, COUNT(*) FROM jobs GROUP BY status"
+            ).fetchall()
+        )
+
+    def failures(self) -> list[tuple[Job, str]]:
+        rows = self.connection.execute(
+            "SELECT teryt, theme, name, priority, error FROM jobs WHERE status = ? "
+            "ORDER BY teryt, theme",
+            (FAILED,),
+        ).fetchall()
+        return [(Job(*row[:4]), row[4]) for row in rows]
+
+    def jobs(self) -> list[Job]:
+        rows = self.connection.execute(
+            "SELECT teryt, theme, name, priority FROM jobs ORDER BY teryt, theme"
+        ).fetchall()
+        return [Job(*row) for row in rows]
@@ -0,0 +1,203 @@
+import asyncio
+import codecs
+import json
+import logging
+import random
+import re
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+
+from httpx import AsyncClient, HTTPStatusError, Limits, Response, TransportError
+from starsep_utils.overpass import DEFAULT_OVERPASS_URL
+
+DEFAULT_CONCURRENCY = 2
+DEFAULT_RETRIES = 5
+DEFAULT_BACKOFF = 2.0
+RETRYABLE_STATUS_CODES = {429, 502, 503, 504}
+
+
+def parseSlotWait(status: str) -> float | None:
+    """Seconds until the next Overpass slot is free, None if one is free now."""
+    if re.search(r"^[1-9]\d* slots? available now", status, re.MULTILINE):
+        return None
+    waits = [int(wait) for wait in re.findall(r"in (-?\d+) seconds", status)]
+    if waits:
+        return max(0, min(waits))
+    return None
+
+
+def retryAfter(response: Response) -> float | None:
+    try:
+        return float(response.headers["Retry-After"])
+    except (KeyError, ValueError):
+        return None
+
+
+class OverpassError(Exception):
+    pass
+
+
+class ElementStreamParser:
+    """Incrementally parses the "elements" array of an Overpass JSON response.
+
+    Text after the array is kept, it holds the remark of a query which failed
+    after some elements were already sent.
+    """
+
+    def __init__(self):
+        self.textDecoder = codecs.getincrementaldecoder("utf-8")()
+        self.jsonDecoder = json.JSONDecoder()
+        self.buffer = ""
+        self.header: str | None = None
+        self.finished = False
+
+    @property
+    def timestampOsmBase(self) -> str | None:
+        match = re.search(r'"timestamp_osm_base"\s*:\s*"([^"]+)"', self.header or "")
+        return match.group(1) if match else None
+
+    @property
+    def remark(self) -> str | None:
+        if not self.finished:
+            return None
+        match = re.search(r'"remark"\s*:\s*("(?:[^"\\]|\\.)*")', self.buffer)
+        return json.loads(match.group(1)) if match else None
+
+    def raiseForIncomplete(self):
+        """Raises when the response ended early or Overpass reported an error.
+
+        Elements received so far are partial then.
+        """
+        if self.header is None:
+            raise OverpassError(f"Not an Overpass JSON response: {self.buffer[:200]!r}")
+        if not self.finished:
+            raise OverpassError("Overpass response ended inside the elements array")
+        remark = self.remark
+        if remark and re.match(r"\s*runtime (error|remark)", remark):
+            raise OverpassError(remark)
+
+    def feed(self, data: bytes) -> list[dict]:
+        self.buffer += self.textDecoder.decode(data)
+        if self.finished:
+            return []
+        if self.header is None:
+            match = re.search(r'"elements"\s*:\s*\[', self.buffer)
+            if match is None:
+                return []
+            self.header = self.buffer[: match.start()]
+            self.buffer = self.buffer[match.end() :]
+        elements = []
+        position = 0
+        while True:
+            while position < len(self.buffer) and self.buffer[position] in " \t\r\n,":
+                position += 1
+            if position == len(self.buffer):
+                break
+            if self.buffer[position] == "]":
+                self.finished = True
+                position += 1
+                break
+            try:
+                element, position = self.jsonDecoder.raw_decode(self.buffer, position)
+            except json.JSONDecodeError:
+                # Element not fully received yet
+                break
+            elements.append(element)
+        self.buffer = self.buffer[position:]
+        return elements
+
+
+class OverpassClient:
+    def __init__(
+        self,
+        url: str = DEFAULT_OVERPASS_URL,
+        concurrency: int = DEFAULT_CONCURRENCY,
+        retries: int = DEFAULT_RETRIES,
+        backoff: float = DEFAULT_BACKOFF,
+        timeout: float = 30.0,
+    ):
+        self.url = url
+        self.statusUrl = url.rsplit("/", 1)[0] + "/status"
+        self.client = AsyncClient(
+            headers={"Accept-Encoding": "gzip"},
+            limits=Limits(max_connections=concurrency),
+            timeout=timeout,
+        )
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.retries = retries
+        self.backoff = backoff
+
+    async def __aenter__(self) -> "OverpassClient":
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.client.aclose()
+
+    async def waitForSlot(self):
+        try:
+            response = await self.client.get(self.statusUrl)
+            response.raise_for_status()
+        except (HTTPStatusError, TransportError):
+            return
+        wait = parseSlotWait(response.text)
+        if wait:
+            logging.info(f"Waiting {wait:.0f}s for Overpass slot")
+            await asyncio.sleep(wait)
+
+    def retryDelay(self, attempt: int, response: Response | None) -> float:
+        delay = retryAfter(response) if response is not None else None
+        if delay is None:
+            delay = random.uniform(0, self.backoff * 2**attempt)
+        return delay
+
+    async def send(
+        self, query: str, stream: bool = False, timeout: float | None = None
+    ) -> Response:
+        """Sends the query, `timeout` overrides the client one.
+
+        It should be longer than the [timeout:] of the query, Overpass answers
+        only once the query is evaluated.
+        """
+        for attempt in range(self.retries + 1):
+            await self.waitForSlot()
+            request = self.client.build_request(
+                "POST",
+                self.url,
+                data=dict(data=query),
+                **({} if timeout is None else dict(timeout=timeout)),
+            )
+            try:
+                response = await self.client.send(request, stream=stream)
+            except TransportError as e:
+                if attempt == self.retries:
+                    raise
+                error, delay = repr(e), self.retryDelay(attempt, None)
+            else:
+                if (
+                    response.status_code not in RETRYABLE_STATUS_CODES
+                    or attempt == self.retries
+                ):
+                    if response.is_error:
+                        await response.aread()
+                        response.raise_for_status()
+                    return response
+                await response.aclose()
+                error = f"HTTP {response.status_code}"
+                delay = self.retryDelay(attempt, response)
+            logging.warning(f"Retrying Overpass query in {delay:.1f}s after {error}")
+            await asyncio.sleep(delay)
+
+    async def post(self, query: str, timeout: float | None = None) -> Response:
+        async with self.semaphore:
+            return await self.send(query, timeout=timeout)
+
+    @asynccontextmanager
+    async def stream(
+        self, query: str, timeout: float | None = None
+    ) -> AsyncIterator[Response]:
+        async with self.semaphore:
+            response = await self.send(query, stream=True, timeout=timeout)
+            try:
+                yield response
+            finally:
+                await response.aclose()
@@ -0,0 +1,119 @@
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Iterator
+
+import numpy as np
+import shapely
+
+try:
+    import osmium
+    from osmium.geom import WKBFactory
+except ImportError:
+    osmium = None
+
+# Nodes of a large extract do not fit in memory with the default storage
+DEFAULT_LOCATION_STORAGE = "flex_mem"
+
+
+def requireOsmium():
+    if osmium is None:
+        raise ImportError("Reading OSM PBF files requires osmium: pip install osmium")
+
+
+@dataclass(frozen=True)
+class WayBatch:
+    """Ways matching a tag filter, way i spans coords[offsets[i]:offsets[i + 1]].
+
+    A way matching several keys appears once per key.
+    """
+
+    wayIds: np.ndarray
+    keys: list[str]
+    values: list[str]
+    coords: np.ndarray
+    offsets: np.ndarray
+
+
+def pbfTimestamp(path: Path) -> str:
+    """Replication timestamp of the extract, modification time if it has none."""
+    requireOsmium()
+    timestamp = osmium.FileProcessor(str(path), osmium.osm.NOTHING).header.get(
+        "osmosis_replication_timestamp"
+    )
+    if timestamp:
+        return timestamp
+    return datetime.fromtimestamp(path.stat().st_mtime, timezone.utc).isoformat()
+
+
+def readTerytAreas(
+    path: Path, terytLength: int = 4, storage: str = DEFAULT_LOCATION_STORAGE
+) -> dict[str, shapely.Geometry]:
+    """Boundaries tagged teryt:terc, powiats by default."""
+    requireOsmium()
+    wkbFactory = WKBFactory()
+    areas = {}
+    processor = (
+        osmium.FileProcessor(str(path))
+        .with_locations(storage)
+        .with_areas(osmium.filter.KeyFilter("teryt:terc"))
+    )
+    for area in processor:
+        if not area.is_area():
+            continue
+        teryt = area.tags.get("teryt:terc")
+        if teryt is None or len(teryt) != terytLength:
+            continue
+        try:
+            areas[teryt] = shapely.from_wkb(wkbFactory.create_multipolygon(area))
+        except RuntimeError:
+            # Broken boundary, e.g. cut off by the extract
+            continue
+    return areas
+
+
+def makeWayBatch(
+    wayIds: list[int], keys: list[str], values: list[str], lines: list[list]
+) -> WayBatch:
+    offsets = np.zeros(len(lines) + 1, dtype=np.int64)
+    np.cumsum([len(line) for line in lines], out=offsets[1:])
+    return WayBatch(
+        wayIds=np.array(wayIds, dtype=np.int64),
+        keys=keys,
+        values=values,
+        coords=np.array([point for line in lines for point in line], dtype=np.float64),
+        offsets=offsets,
+    )
+
+
+def iterWayBatches(
+    path: Path,
+    tagFilter: dict[str, set[str]],
+    batchSize: int,
+    storage: str = DEFAULT_LOCATION_STORAGE,
+) -> Iterator[WayBatch]:
+    """Streams ways whose tag `key` has one of `tagFilter[key]` values."""
+    requireOsmium()
+    processor = (
+        osmium.FileProcessor(str(path), osmium.osm.NODE | osmium.osm.WAY)
+        .with_locations(storage)
+        .with_filter(osmium.filter.EntityFilter(osmium.osm.WAY))
+        .with_filter(osmium.filter.KeyFilter(*tagFilter))
+    )
+    wayIds, keys, values, lines = [], [], [], []
+    for way in processor:
+        line = [(node.lon, node.lat) for node in way.nodes if node.location.valid()]
+        if len(line) < 2:
+            continue
+        for key, acceptedValues in tagFilter.items():
+            value = way.tags.get(key)
+            if value in acceptedValues:
+                wayIds.append(way.id)
+                keys.append(key)
+                values.append(value)
+                lines.append(line)
+        if len(lines) >= batchSize:
+            yield makeWayBatch(wayIds, keys, values, lines)
+            wayIds, keys, values, lines = [], [], [], []
+    if lines:
+        yield makeWayBatch(wayIds, keys, values, lines)
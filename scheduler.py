@@ -0,0 +1,160 @@
+import asyncio
+import inspect
+import logging
+import time
+from contextlib import nullcontext
+from dataclasses import dataclass, field
+from typing import Any, Callable, Iterable
+
+from tqdm import tqdm
+
+
+def activeTime(intervals: list[tuple[float, float]]) -> float:
+    """Length of the union of time intervals."""
+    total = 0.0
+    activeEnd = float("-inf")
+    for start, end in sorted(intervals):
+        total += max(0.0, end - max(start, activeEnd))
+        activeEnd = max(activeEnd, end)
+    return total
+
+
+@dataclass(eq=False)
+class Task:
+    name: str
+    # Coroutine function, or a blocking function run in a thread
+    function: Callable[..., Any]
+    # Task arguments are replaced by their results before the call
+    args: tuple
+    dependencies: tuple["Task", ...]
+    resource: str | None = None
+    start: float | None = None
+    end: float | None = None
+    future: asyncio.Future | None = field(default=None, repr=False)
+
+    @property
+    def duration(self) -> float:
+        if self.start is None or self.end is None:
+            return 0.0
+        return self.end - self.start
+
+
+class Scheduler:
+    """Runs a DAG of tasks, each as soon as its dependencies are done.
+
+    Tasks of a resource with a limit run at most that many at a time. Blocking
+    functions run in threads, so that they do not stall the event loop.
+    """
+
+    def __init__(self, limits: dict[str, int] | None = None):
+        self.semaphores = {
+            resource: asyncio.Semaphore(limit)
+            for resource, limit in (limits or {}).items()
+        }
+        self.tasks: list[Task] = []
+        self.startTime: float | None = None
+        self.endTime: float | None = None
+
+    def add(
+        self,
+        name: str,
+        function: Callable[..., Any],
+        *args,
+        after: Iterable[Task] = (),
+        resource: str | None = None,
+    ) -> Task:
+        dependencies = tuple(arg for arg in args if isinstance(arg, Task))
+        task = Task(
+            name=name,
+            function=function,
+            args=args,
+            dependencies=dependencies + tuple(after),
+            resource=resource,
+        )
+        self.tasks.append(task)
+        return task
+
+    async def runTask(self, task: Task, progress: tqdm) -> Any:
+        await asyncio.gather(*(dependency.future for dependency in task.dependencies))
+        args = [
+            arg.future.result() if isinstance(arg, Task) else arg for arg in task.args
+        ]
+        async with self.semaphores.get(task.resource) or nullcontext():
+            task.start = time.perf_counter()
+            try:
+                if inspect.iscoroutinefunction(task.function):
+                    return await task.function(*args)
+                return await asyncio.to_thread(task.function, *args)
+            except Exception:
+                logging.exception(f"{task.name} failed")
+                raise
+            finally:
+                task.end = time.perf_counter()
+                progress.update()
+
+    async def run(self):
+        """Runs all tasks, raises the first failure once the others are done.
+
+        Tasks depending on a failed task are not started.
+        """
+        self.startTime = time.perf_counter()
+        with tqdm(total=len(self.tasks)) as progress:
+            # Tasks are added after their dependencies, so futures exist in time
+            for task in self.tasks:
+                task.future = asyncio.ensure_future(self.runTask(task, progress))
+            results = await asyncio.gather(
+                *(task.future for task in self.tasks), return_exceptions=True
+            )
+        self.endTime = time.perf_counter()
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+
+    def criticalPath(self) -> list[Task]:
+        """Chain of tasks ending with the last one, each waiting for the previous."""
+        finished = [task for task in self.tasks if task.end is not None]
+        if not finished:
+            return []
+        path = [max(finished, key=lambda task: task.end)]
+        while True:
+            dependencies = [
+                dependency
+                for dependency in path[-1].dependencies
+                if dependency.end is not None
+            ]
+            if not dependencies:
+                break
+            path.append(max(dependencies, key=lambda task: task.end))
+        return path[::-1]
+
+    def logTimings(self):
+        wallTime = self.endTime - self.startTime
+        intervals = {}
+        for task in self.tasks:
+            if task.end is not None:
+                intervals.setdefault(task.resource, []).append((task.start, task.end))
+        busyTime = {
+            resource: sum(end - start for start, end in resourceIntervals)
+            for resource, resourceIntervals in intervals.items()
+        }
+        totalBusyTime = sum(busyTime.values())
+        logging.info(
+            f"Ran {len(self.tasks)} tasks in {wallTime:.1f}s, "
+            f"{totalBusyTime:.1f}s if run one after another "
+            f"({totalBusyTime / max(wallTime, 1e-9):.1f} running on average)"
+        )
+        for resource, seconds in sorted(busyTime.items(), key=lambda item: -item[1]):
+            logging.info(
+                f"  {resource}: busy {seconds:.1f}s, "
+                f"active {activeTime(intervals[resource]):.1f}s"
+            )
+        path = self.criticalPath()
+        logging.info(
+            f"Critical path busy for {sum(task.duration for task in path):.1f}s "
+            f"of {wallTime:.1f}s, gaps are waits for resource limits:"
+        )
+        for task in path:
+            logging.info(
+                f"  {task.start - self.startTime:8.1f}s +{task.duration:6.1f}s "
+                f"{task.name}"
+            )
@@ -0,0 +1,99 @@
+import tempfile
+import unittest
+from pathlib import Path
+
+import numpy as np
+from h3.api import numpy_int as h3int
+
+from cellset import ARRAY_LIMIT, CellSet
+
+RESOLUTION = 12
+# Res 7 cells in Warszawa, each one container of the set
+PARENTS = [h3int.geo_to_h3(52.2 + i * 0.05, 21.0, 7) for i in range(4)]
+
+
+def children(parent: int, count: int, seed: int = 0) -> np.ndarray:
+    cells = np.asarray(h3int.h3_to_children(parent, RESOLUTION), dtype=np.uint64)
+    rng = np.random.default_rng(seed)
+    return np.sort(rng.choice(cells, count, replace=False))
+
+
+def fixtureCells(seed: int = 0) -> np.ndarray:
+    """Array and bitmap containers, with exactly ARRAY_LIMIT children in one."""
+    counts = [10, ARRAY_LIMIT, ARRAY_LIMIT + 1, 6000]
+    return np.sort(
+        np.concatenate(
+            [
+                children(parent, count, seed + i)
+                for i, (parent, count) in enumerate(zip(PARENTS, counts))
+            ]
+        )
+    )
+
+
+class CellSetTest(unittest.TestCase):
+    def assertSameCells(self, cellSet: CellSet, cells: np.ndarray):
+        self.assertEqual(cellSet.toCells().dtype, np.uint64)
+        self.assertTrue(np.array_equal(cellSet.toCells(), cells))
+        self.assertEqual(len(cellSet), len(cells))
+
+    def testRoundTrip(self):
+        cells = fixtureCells()
+        cellSet = CellSet.fromCells(cells, RESOLUTION)
+        self.assertSameCells(cellSet, cells)
+        # Only containers with more than ARRAY_LIMIT children are bitmaps
+        self.assertEqual(list(cellSet.bitmapIndex >= 0), [False, False, True, True])
+        self.assertSameCells(CellSet.fromCells(cells[:0], RESOLUTION), cells[:0])
+
+    def testContains(self):
+        cells = fixtureCells()
+        cellSet = CellSet.fromCells(cells, RESOLUTION)
+        queries = np.concatenate(
+            [
+                np.concatenate(
+                    [h3int.h3_to_children(parent, RESOLUTION) for parent in PARENTS]
+                ).astype(np.uint64),
+                # Children of another parent, coarser cells and garbage
+                children(h3int.geo_to_h3(50.0, 20.0, 7), 100),
+                np.asarray(PARENTS, dtype=np.uint64),
+                np.array([0, 2**64 - 1], dtype=np.uint64),
+            ]
+        )
+        self.assertTrue(
+            np.array_equal(cellSet.contains(queries), np.isin(queries, cells))
+        )
+        empty = CellSet.fromCells(cells[:0], RESOLUTION)
+        self.assertFalse(empty.contains(queries).any())
+        self.assertEqual(len(cellSet.contains(queries[:0])), 0)
+
+    def testUnionAndIntersection(self):
+        first, second = fixtureCells(0), fixtureCells(1)
+        firstSet = CellSet.fromCells(first, RESOLUTION)
+        secondSet = CellSet.fromCells(second, RESOLUTION)
+        self.assertSameCells(firstSet.union(secondSet), np.union1d(first, second))
+        self.assertSameCells(firstSet.union(), first)
+        self.assertSameCells(
+            firstSet.intersection(secondSet), np.intersect1d(first, second)
+        )
+        empty = CellSet.fromCells(first[:0], RESOLUTION)
+        self.assertSameCells(firstSet.intersection(empty), first[:0])
+        self.assertSameCells(empty.union(firstSet), first)
+
+    def testSaveAndLoad(self):
+        cells = fixtureCells()
+        cellSet = CellSet.fromCells(cells, RESOLUTION)
+        with tempfile.TemporaryDirectory() as directory:
+            cellSet.save(Path(directory), "cells")
+            for mmap in (False, True):
+                loaded = CellSet.load(Path(directory), "cells", mmap=mmap)
+                self.assertEqual(loaded.resolution, RESOLUTION)
+                self.assertEqual(isinstance(loaded.lows, np.memmap), mmap)
+                self.assertSameCells(loaded, cells)
+                self.assertTrue(
+                    np.array_equal(loaded.contains(cells), np.ones(len(cells), bool))
+                )
+                del loaded
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,102 @@
+import unittest
+from unittest import mock
+
+import numpy as np
+
+import bdot
+from benchmark import WARSZAWA, syntheticLines
+
+OSM_LINES = 2_000
+BDOT_LINES = 20_000
+SCATTERED_LINES = 2_000
+# Most BDOT lines are OSM segments moved sideways by up to this many metres,
+# about the distance at which OSM_NEIGHBOURHOOD_SIZE rings stop matching
+MAX_SHIFT_M = 30.0
+
+
+def shiftedSegments(
+    coords: np.ndarray, offsets: np.ndarray, count: int, seed: int = 0
+) -> tuple[np.ndarray, np.ndarray]:
+    """`count` lines, each the middle of a random segment of the given lines,
+    moved sideways by 0-MAX_SHIFT_M."""
+    rng = np.random.default_rng(seed)
+    isLast = np.zeros(len(coords), dtype=bool)
+    isLast[offsets[1:] - 1] = True
+    starts = rng.choice(np.flatnonzero(~isLast), count)
+    # Metres east and north per degree
+    scale = (
+        np.radians(1)
+        * bdot.EARTH_RADIUS_M
+        * np.array([np.cos(np.radians(WARSZAWA[1])), 1.0])
+    )
+    start, end = coords[starts], coords[starts + 1]
+    direction = (end - start) * scale
+    direction /= np.linalg.norm(direction, axis=1, keepdims=True)
+    sideways = direction[:, ::-1] * [-1, 1]
+    move = sideways * rng.uniform(0, MAX_SHIFT_M, (count, 1)) / scale
+    lines = np.stack([start + (end - start) * 0.2, start + (end - start) * 0.8], 1)
+    lines += move[:, np.newaxis]
+    return lines.reshape(-1, 2), np.arange(count + 1, dtype=np.int64) * 2
+
+
+def allLinesNear(
+    coords: np.ndarray, offsets: np.ndarray, coverage: bdot.Coverage
+) -> np.ndarray:
+    return np.ones(len(offsets) - 1, dtype=bool)
+
+
+class FindMissingLinesTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        osmCoords, osmOffsets = syntheticLines(OSM_LINES, extent=0.4)
+        cls.coverage = bdot.makeCoverage(bdot.rasterizeLines(osmCoords, osmOffsets))
+        shifted = shiftedSegments(osmCoords, osmOffsets, BDOT_LINES - SCATTERED_LINES)
+        # Lines anywhere around the OSM ones, partly outside of their area
+        scattered = syntheticLines(SCATTERED_LINES, extent=0.6, seed=1)
+        cls.coords = np.concatenate([shifted[0], scattered[0]])
+        cls.offsets = np.concatenate([shifted[1], scattered[1][1:] + len(shifted[0])])
+
+    def findMissingLines(self, neighbourhoodSize: int, dilationSide: str):
+        with mock.patch.object(bdot, "DILATION_SIDE", dilationSide):
+            return bdot.findMissingLines(
+                self.coords, self.offsets, self.coverage, neighbourhoodSize
+            )
+
+    def testDilationSidesAndPrefilterAgree(self):
+        for neighbourhoodSize in (0, bdot.OSM_NEIGHBOURHOOD_SIZE, 3):
+            with self.subTest(neighbourhoodSize=neighbourhoodSize):
+                expected = self.findMissingLines(neighbourhoodSize, "bdot")
+                # Both outcomes are common, so that disagreements would show
+                self.assertGreater(expected.sum(), len(expected) // 20)
+                self.assertGreater((~expected).sum(), len(expected) // 20)
+                for dilationSide in ("osm", "auto"):
+                    self.assertTrue(
+                        np.array_equal(
+                            self.findMissingLines(neighbourhoodSize, dilationSide),
+                            expected,
+                        ),
+                        dilationSide,
+                    )
+                with mock.patch.object(bdot, "findLinesNearCoverage", allLinesNear):
+                    for dilationSide in ("osm", "bdot"):
+                        self.assertTrue(
+                            np.array_equal(
+                                self.findMissingLines(neighbourhoodSize, dilationSide),
+                                expected,
+                            ),
+                            f"{dilationSide} without prefilter",
+                        )
+
+    def testDilatedCoverage(self):
+        size = bdot.OSM_NEIGHBOURHOOD_SIZE
+        dilated = bdot.dilateCoverage(self.coverage, size)
+        self.assertTrue(
+            np.array_equal(
+                bdot.findMissingLines(self.coords, self.offsets, dilated, size),
+                self.findMissingLines(size, "bdot"),
+            )
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
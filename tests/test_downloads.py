@@ -0,0 +1,83 @@
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+import httpx
+
+from downloads import Downloader
+
+URL = "https://example.com/data/0201.zip"
+
+
+class DownloaderTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = Path(directory.name) / "0201.zip"
+        self.delays = []
+        sleep = mock.patch("downloads.asyncio.sleep", side_effect=self.sleep)
+        sleep.start()
+        self.addCleanup(sleep.stop)
+
+    async def sleep(self, delay: float):
+        self.delays.append(delay)
+
+    def downloader(self, responses: list, **kwargs) -> Downloader:
+        """Downloader answering requests with `responses` in order."""
+        self.requests = []
+
+        def handler(request: httpx.Request) -> httpx.Response:
+            self.requests.append(request)
+            response = responses[min(len(self.requests), len(responses)) - 1]
+            if isinstance(response, Exception):
+                raise response
+            return response
+
+        downloader = Downloader(backoff=1.0, **kwargs)
+        downloader.client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        return downloader
+
+    async def testRetriesWithExponentialBackoff(self):
+        responses = [
+            httpx.Response(503),
+            httpx.ConnectError("refused"),
+            httpx.Response(429),
+            httpx.Response(200, content=b"archive"),
+        ]
+        with self.assertLogs(level="WARNING") as logs:
+            async with self.downloader(responses) as downloader:
+                await downloader.download(URL, self.path)
+        self.assertEqual(len(logs.records), 3)
+        self.assertEqual(self.path.read_bytes(), b"archive")
+        self.assertEqual(self.delays, [1.0, 2.0, 4.0])
+        self.assertEqual(downloader.bytesDownloaded, len(b"archive"))
+        self.assertFalse(self.path.with_suffix(".part").exists())
+
+    async def testGivesUpAfterRetries(self):
+        with self.assertLogs(level="WARNING"):
+            async with self.downloader([httpx.Response(502)], retries=2) as downloader:
+                with self.assertRaises(httpx.HTTPStatusError):
+                    await downloader.download(URL, self.path)
+        self.assertEqual(len(self.requests), 3)
+        self.assertEqual(self.delays, [1.0, 2.0])
+        self.assertFalse(self.path.exists())
+
+    async def testDoesNotRetryClientErrors(self):
+        async with self.downloader([httpx.Response(404)]) as downloader:
+            with self.assertRaises(httpx.HTTPStatusError):
+                await downloader.download(URL, self.path)
+        self.assertEqual(len(self.requests), 1)
+        self.assertEqual(self.delays, [])
+
+    async def testContentLength(self):
+        responses = [httpx.Response(200, headers={"Content-Length": "1234"})]
+        async with self.downloader(responses) as downloader:
+            self.assertEqual(await downloader.contentLength(URL), 1234)
+        with self.assertLogs(level="WARNING"):
+            async with self.downloader([httpx.Response(500)]) as downloader:
+                self.assertIsNone(await downloader.contentLength(URL))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,190 @@
+import json
+import re
+import tempfile
+import unittest
+import urllib.parse
+from datetime import timedelta
+from pathlib import Path
+from unittest import mock
+
+import httpx
+import numpy as np
+
+import bdot
+from overpass import OverpassClient, OverpassError
+
+TERYT = "1465"
+THEME = bdot.Theme("roads", "highway", ("service", "footway"), "OT_SKJZ_L")
+BASE = "2024-01-01T00:00:00Z"
+CHANGE = "2024-02-01T00:00:00Z"
+
+
+def line(x: float, y: float) -> list[list[float]]:
+    return [[21.0 + x, 52.2 + y], [21.0 + x, 52.201 + y], [21.001 + x, 52.202 + y]]
+
+
+def osmState(
+    edited: bool, boundaryMoved: bool = False
+) -> dict[int, tuple[str, list, str]]:
+    """Way id to (highway value, geometry, last change), before or after edits."""
+    ways = {i: ("service", line(i * 0.002, 0), BASE) for i in range(1, 40)}
+    ways[7] = ("footway", ways[7][1], BASE)
+    if edited:
+        # Deleted, moved, retagged, created and moved through a node
+        del ways[2]
+        ways[3] = ("service", line(0.1, 0.1), CHANGE)
+        ways[5] = ("footway", ways[5][1], CHANGE)
+        ways[8] = ("service", ways[8][1], CHANGE)
+        ways[100] = ("footway", line(0.2, 0.1), CHANGE)
+        ways[11] = ("service", line(11 * 0.002, 0.0005), CHANGE)
+    if boundaryMoved:
+        # Unchanged, but inside the area since its boundary moved
+        ways[200] = ("service", line(0.3, 0.1), BASE)
+    return ways
+
+
+class MockOverpass:
+    """Answers full and `newer:` update queries from osmState."""
+
+    def __init__(self):
+        self.edited = False
+        self.boundaryMoved = False
+        self.timedOut = False
+        self.queries = []
+
+    def handler(self, request: httpx.Request) -> httpx.Response:
+        if request.url.path.endswith("/status"):
+            return httpx.Response(200, text="2 slots available now.")
+        query = urllib.parse.parse_qs(request.content.decode())["data"][0]
+        self.queries.append(query)
+        values = re.search(r"\^\((.*)\)\$", query).group(1).split("|")
+        newer = re.search(r'newer:"([^"]+)"', query)
+        ways = {
+            wayId: way
+            for wayId, way in osmState(self.edited, self.boundaryMoved).items()
+            if way[0] in values
+        }
+        items = [
+            {
+                "type": "item",
+                "id": wayId,
+                "tags": {"highway": value, "_osm_type": "way"},
+                "geometry": {"type": "LineString", "coordinates": geometry},
+            }
+            for wayId, (value, geometry, changed) in ways.items()
+            if newer is None or changed > newer.group(1)
+        ]
+        elements = items
+        if newer is not None:
+            elements = [
+                {"type": "way", "id": wayId, "tags": {"highway": value}}
+                for wayId, (value, _, _) in ways.items()
+            ] + items
+        body = {
+            "osm3s": {"timestamp_osm_base": CHANGE if self.edited else BASE},
+            "elements": elements,
+        }
+        if self.timedOut:
+            body["elements"] = elements[:3]
+            body["remark"] = 'runtime error: Query timed out in "query" at line 4'
+        return httpx.Response(200, content=json.dumps(body).encode())
+
+
+class IncrementalUpdateTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.cacheDir = Path(directory.name)
+        for name, value in dict(
+            coverageCacheDir=self.cacheDir,
+            # Cached coverage is always expired, so that it is updated
+            COVERAGE_CACHE_MAX_AGE=timedelta(0),
+            INCREMENTAL_OSM_UPDATES=True,
+            OSM_SOURCE="overpass",
+            OSM_WORKERS=1,
+            pendingCoverages={},
+        ).items():
+            patch = mock.patch.object(bdot, name, value)
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.overpass = MockOverpass()
+
+    async def getOSMData(self) -> bdot.Coverage:
+        async with OverpassClient("https://overpass.example.com/api/interpreter") as o:
+            o.client = httpx.AsyncClient(
+                transport=httpx.MockTransport(self.overpass.handler)
+            )
+            return await bdot.getOSMData(THEME, TERYT, o)
+
+    def assertSameCoverage(self, first: bdot.Coverage, second: bdot.Coverage):
+        self.assertTrue(np.array_equal(first.cells.toCells(), second.cells.toCells()))
+        self.assertTrue(np.array_equal(first.coarseCells, second.coarseCells))
+        self.assertEqual(first.neighbourhoodSize, second.neighbourhoodSize)
+
+    def clearCache(self):
+        for entry in self.cacheDir.iterdir():
+            if entry.is_dir():
+                bdot.shutil.rmtree(entry)
+
+    async def testPatchedCoverageEqualsFullDownload(self):
+        before = await self.getOSMData()
+        self.overpass.edited = True
+        with self.assertLogs(level="INFO") as logs:
+            patched = await self.getOSMData()
+        self.assertIn(f'newer:"{BASE}"', self.overpass.queries[-1])
+        self.assertTrue(any("Updated OSM coverage" in line for line in logs.output))
+        self.clearCache()
+        full = await self.getOSMData()
+        self.assertNotIn("newer:", self.overpass.queries[-1])
+        self.assertSameCoverage(patched, full)
+        self.assertFalse(np.array_equal(before.cells.toCells(), full.cells.toCells()))
+
+    async def testNewlyMatchingWaysAreDownloaded(self):
+        await self.getOSMData()
+        self.overpass.edited = True
+        self.overpass.boundaryMoved = True
+        queryCount = len(self.overpass.queries)
+        with self.assertLogs(level="INFO") as logs:
+            patched = await self.getOSMData()
+        queries = self.overpass.queries[queryCount:]
+        self.assertIn(f'newer:"{BASE}"', queries[0])
+        # Only the value with a newly matching way is downloaded again
+        self.assertNotIn("newer:", queries[1])
+        self.assertIn('"^(service)$"', queries[1])
+        self.assertEqual(len(queries), 2)
+        self.assertTrue(any("Downloading service" in line for line in logs.output))
+        self.clearCache()
+        self.assertSameCoverage(patched, await self.getOSMData())
+
+    async def testTimedOutUpdateIsNotApplied(self):
+        before = await self.getOSMData()
+        cached = {
+            path: path.read_bytes()
+            for path in self.cacheDir.glob("*/*")
+            if path.is_file()
+        }
+        self.overpass.edited = True
+        self.overpass.timedOut = True
+        with self.assertRaises(OverpassError):
+            await self.getOSMData()
+        self.assertEqual(
+            cached,
+            {
+                path: path.read_bytes()
+                for path in self.cacheDir.glob("*/*")
+                if path.is_file()
+            },
+        )
+        # The next update starts from the coverage before the failed one
+        self.overpass.timedOut = False
+        patched = await self.getOSMData()
+        self.assertIn(f'newer:"{BASE}"', self.overpass.queries[-1])
+        self.clearCache()
+        self.assertSameCoverage(patched, await self.getOSMData())
+        self.assertFalse(
+            np.array_equal(before.cells.toCells(), patched.cells.toCells())
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,115 @@
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+from jobs import DONE, FAILED, PENDING, RUNNING, Job, JobQueue
+
+ROADS = Job("1465", "roads", "Warszawa", priority=2)
+FOOTWAYS = Job("1465", "footways", "Warszawa", priority=1)
+POWERLINES = Job("0201", "powerlines", "bolesławiecki")
+
+
+class JobQueueTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = Path(directory.name) / "jobs.sqlite"
+        self.now = 1000.0
+        clock = mock.patch("jobs.time.time", side_effect=lambda: self.now)
+        clock.start()
+        self.addCleanup(clock.stop)
+
+    def queue(self, worker: str, **kwargs) -> JobQueue:
+        queue = JobQueue(self.path, **kwargs)
+        queue.worker = worker
+        self.addCleanup(queue.connection.close)
+        return queue
+
+    def status(self, job: Job) -> tuple[str, int]:
+        return (
+            self.queue("status")
+            .connection.execute(
+                "SELECT status, attempts FROM jobs WHERE teryt = ? AND theme = ?",
+                (job.teryt, job.theme),
+            )
+            .fetchone()
+        )
+
+    def testClaimsByPriority(self):
+        queue = self.queue("a")
+        queue.add([POWERLINES, FOOTWAYS, ROADS])
+        queue.add([FOOTWAYS])
+        self.assertEqual(
+            [queue.claim(), queue.claim(), queue.claim(), queue.claim()],
+            [ROADS, FOOTWAYS, POWERLINES, None],
+        )
+        self.assertEqual(queue.counts(), {RUNNING: 3})
+
+    def testWorkersDoNotShareJobs(self):
+        first, second = self.queue("a"), self.queue("b")
+        first.add([ROADS, FOOTWAYS])
+        self.assertEqual({first.claim(), second.claim()}, {ROADS, FOOTWAYS})
+        self.assertIsNone(first.claim())
+
+    def testExpiredLeaseIsClaimedAgain(self):
+        first, second = self.queue("a", lease=60), self.queue("b", lease=60)
+        first.add([ROADS])
+        self.assertEqual(first.claim(), ROADS)
+        self.now += 50
+        first.heartbeat([ROADS])
+        self.now += 50
+        self.assertIsNone(second.claim())
+        self.now += 20
+        self.assertEqual(second.claim(), ROADS)
+        # The first worker lost the job, its outcome is ignored
+        first.finish(ROADS)
+        first.fail(ROADS, "late")
+        self.assertEqual(self.status(ROADS), (RUNNING, 2))
+        second.finish(ROADS)
+        self.assertEqual(self.status(ROADS), (DONE, 2))
+
+    def testJobKillingWorkersFails(self):
+        queue = self.queue("a", lease=60, attempts=3)
+        queue.add([ROADS])
+        for _ in range(3):
+            self.assertEqual(queue.claim(), ROADS)
+            # The worker dies without a heartbeat
+            self.now += 61
+        self.assertIsNone(queue.claim())
+        [(job, error)] = queue.failures()
+        self.assertEqual((job, self.status(ROADS)), (ROADS, (FAILED, 3)))
+        self.assertIn("heartbeat", error)
+
+    def testFailsAfterAttempts(self):
+        queue = self.queue("a", attempts=2)
+        queue.add([ROADS])
+        queue.claim()
+        queue.fail(ROADS, "HTTP 503")
+        self.assertEqual(self.status(ROADS), (PENDING, 1))
+        self.assertEqual(queue.claim(), ROADS)
+        queue.fail(ROADS, "HTTP 504")
+        self.assertIsNone(queue.claim())
+        self.assertEqual(queue.failures(), [(ROADS, "HTTP 504")])
+        queue.retryFailed()
+        self.assertEqual(queue.claim(), ROADS)
+        queue.finish(ROADS)
+        self.assertEqual(queue.counts(), {DONE: 1})
+
+    def testReleaseDoesNotCountAttempt(self):
+        queue = self.queue("a")
+        queue.add([ROADS])
+        queue.claim()
+        queue.release(ROADS)
+        self.assertEqual(self.status(ROADS), (PENDING, 0))
+
+    def testSurvivesReopening(self):
+        with JobQueue(self.path) as queue:
+            queue.add([ROADS, POWERLINES])
+        with JobQueue(self.path) as queue:
+            self.assertEqual(queue.jobs(), [POWERLINES, ROADS])
+            self.assertEqual(queue.counts(), {PENDING: 2})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,161 @@
+import unittest
+from unittest import mock
+
+import httpx
+
+from overpass import ElementStreamParser, OverpassClient, OverpassError, parseSlotWait
+
+URL = "https://overpass.example.com/api/interpreter"
+STATUS = """Connected as: 123
+Current time: 2024-01-01T00:00:00Z
+Rate limit: 2
+{slots}
+Currently running queries (pid, space limit, time limit, start time):
+"""
+
+
+class ParseSlotWaitTest(unittest.TestCase):
+    def testFreeSlot(self):
+        self.assertIsNone(parseSlotWait(STATUS.format(slots="2 slots available now.")))
+        self.assertIsNone(parseSlotWait(STATUS.format(slots="1 slot available now.")))
+
+    def testNoFreeSlot(self):
+        slots = (
+            "0 slots available now.\n"
+            "Slot available after: 2024-01-01T00:00:12Z, in 12 seconds.\n"
+            "Slot available after: 2024-01-01T00:00:30Z, in 30 seconds."
+        )
+        self.assertEqual(parseSlotWait(STATUS.format(slots=slots)), 12)
+
+    def testSlotAlreadyFree(self):
+        slots = "Slot available after: 2024-01-01T00:00:00Z, in -3 seconds."
+        self.assertEqual(parseSlotWait(STATUS.format(slots=slots)), 0)
+
+
+def feedInChunks(body: bytes, size: int) -> tuple[ElementStreamParser, list[dict]]:
+    parser = ElementStreamParser()
+    elements = []
+    for start in range(0, len(body), size):
+        elements += parser.feed(body[start : start + size])
+    return parser, elements
+
+
+class ElementStreamParserTest(unittest.TestCase):
+    BODY = (
+        '{"version": 0.6, "osm3s": {"timestamp_osm_base": "2024-01-01T00:00:00Z"},\n'
+        '"elements": [\n{"type": "way", "id": 1, "tags": {"name": "Żelazna"}},\n'
+        '{"type": "way", "id": 2}\n]%s}'
+    )
+
+    def testStreamsElements(self):
+        body = (self.BODY % "").encode()
+        for size in (1, 3, len(body)):
+            parser, elements = feedInChunks(body, size)
+            self.assertEqual([element["id"] for element in elements], [1, 2])
+            self.assertEqual(elements[0]["tags"]["name"], "Żelazna")
+            self.assertEqual(parser.timestampOsmBase, "2024-01-01T00:00:00Z")
+            self.assertIsNone(parser.remark)
+            parser.raiseForIncomplete()
+
+    def testRaisesForRuntimeError(self):
+        remark = 'runtime error: Query timed out in \\"query\\" at line 3'
+        body = (self.BODY % f',\n"remark": "{remark}"\n').encode()
+        for size in (1, 7, len(body)):
+            parser, elements = feedInChunks(body, size)
+            self.assertEqual(len(elements), 2)
+            self.assertEqual(
+                parser.remark, 'runtime error: Query timed out in "query" at line 3'
+            )
+            with self.assertRaises(OverpassError):
+                parser.raiseForIncomplete()
+
+    def testRaisesForTruncatedResponse(self):
+        body = (self.BODY % "").encode()
+        end = body.index(b"]")
+        for length in (end - 30, end - 1):
+            parser, elements = feedInChunks(body[:length], 5)
+            self.assertLessEqual(len(elements), 2)
+            with self.assertRaises(OverpassError):
+                parser.raiseForIncomplete()
+
+    def testRaisesForOtherResponses(self):
+        body = b"<html><body>502 Bad Gateway</body></html>"
+        parser, elements = feedInChunks(body, len(body))
+        self.assertEqual(elements, [])
+        with self.assertRaises(OverpassError):
+            parser.raiseForIncomplete()
+
+
+class OverpassClientTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.delays = []
+        sleep = mock.patch("overpass.asyncio.sleep", side_effect=self.sleep)
+        sleep.start()
+        self.addCleanup(sleep.stop)
+
+    async def sleep(self, delay: float):
+        self.delays.append(delay)
+
+    def client(self, responses: list, status: str, **kwargs) -> OverpassClient:
+        """Client answering queries with `responses` in order."""
+        self.queries = []
+
+        def handler(request: httpx.Request) -> httpx.Response:
+            if request.url.path.endswith("/status"):
+                return httpx.Response(200, text=status)
+            self.queries.append(request)
+            return responses[min(len(self.queries), len(responses)) - 1]
+
+        overpass = OverpassClient(URL, backoff=1.0, **kwargs)
+        overpass.client = httpx.AsyncClient(
+            transport=httpx.MockTransport(handler), timeout=overpass.client.timeout
+        )
+        return overpass
+
+    async def testWaitsForSlot(self):
+        status = STATUS.format(
+            slots="0 slots available now.\n"
+            "Slot available after: 2024-01-01T00:00:07Z, in 7 seconds."
+        )
+        async with self.client([httpx.Response(200, json={})], status) as overpass:
+            with self.assertLogs(level="INFO"):
+                await overpass.post("query")
+        self.assertEqual(self.delays, [7])
+
+    async def testRetriesRateLimitedQueries(self):
+        responses = [
+            httpx.Response(429, headers={"Retry-After": "5"}),
+            httpx.Response(504),
+            httpx.Response(200, json={"elements": []}),
+        ]
+        status = STATUS.format(slots="2 slots available now.")
+        async with self.client(responses, status) as overpass:
+            with self.assertLogs(level="WARNING"):
+                response = await overpass.post("query")
+        self.assertEqual(response.json(), {"elements": []})
+        self.assertEqual(len(self.queries), 3)
+        self.assertEqual(self.delays[0], 5.0)
+        self.assertLessEqual(self.delays[1], 2.0)
+
+    async def testDoesNotRetryBadQueries(self):
+        status = STATUS.format(slots="2 slots available now.")
+        async with self.client([httpx.Response(400)], status) as overpass:
+            with self.assertRaises(httpx.HTTPStatusError):
+                await overpass.post("query")
+        self.assertEqual(len(self.queries), 1)
+
+    async def testRequestTimeout(self):
+        status = STATUS.format(slots="2 slots available now.")
+        responses = [httpx.Response(200, json={"elements": []})]
+        async with self.client(responses, status, timeout=30.0) as overpass:
+            await overpass.post("query", timeout=90.0)
+            async with overpass.stream("query") as response:
+                await response.aread()
+        self.assertEqual(
+            [query.extensions["timeout"]["read"] for query in self.queries],
+            [90.0, 30.0],
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
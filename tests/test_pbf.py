@@ -0,0 +1,147 @@
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+import numpy as np
+import shapely
+
+import bdot
+import pbf
+
+TIMESTAMP = "2024-03-01T00:00:00Z"
+# Powiat squares (teryt, west, east), all between latitudes SOUTH and NORTH
+POWIATS = [("9999", 21.0, 21.05), ("9998", 21.05, 21.1)]
+SOUTH, NORTH = 52.19, 52.21
+
+
+def fixtureWays() -> list[tuple[int, dict[str, str], list[tuple[float, float]]]]:
+    ways = []
+    for i in range(60):
+        x = 21.001 + i * 0.0016
+        value = ["service", "footway", "residential", "line"][i % 4]
+        tags = {"power" if value == "line" else "highway": value}
+        if i == 8:
+            # Matches themes of two keys
+            tags["power"] = "minor_line"
+        ways.append(
+            (i + 1, tags, [(x, 52.2), (x + 0.0004, 52.2005), (x + 0.0008, 52.2)])
+        )
+    # Crossing the border of both powiats
+    ways.append((500, {"highway": "service"}, [(21.049, 52.195), (21.051, 52.195)]))
+    # Outside of both
+    ways.append((501, {"highway": "service"}, [(22.0, 52.195), (22.001, 52.195)]))
+    return ways
+
+
+def writeFixture(path: Path):
+    from osmium.osm.mutable import Node, Relation, Way
+
+    header = pbf.osmium.io.Header()
+    header.set("osmosis_replication_timestamp", TIMESTAMP)
+    writer = pbf.osmium.SimpleWriter(str(path), header=header)
+    nodes, ways, relations = [], [], []
+
+    def node(lon: float, lat: float) -> int:
+        nodes.append(Node(id=len(nodes) + 1, location=(lon, lat), version=1))
+        return len(nodes)
+
+    def boundary(teryt: str, west: float, east: float):
+        corners = [node(west, SOUTH), node(east, SOUTH), node(east, NORTH)]
+        corners += [node(west, NORTH), corners[0]]
+        wayId = 1000 + len(relations)
+        ways.append(Way(id=wayId, nodes=corners, tags={}, version=1))
+        tags = {
+            "type": "boundary",
+            "boundary": "administrative",
+            "teryt:terc": teryt,
+        }
+        members = [("w", wayId, "outer")]
+        relations.append(
+            Relation(id=len(relations) + 1, members=members, tags=tags, version=1)
+        )
+
+    for teryt, west, east in POWIATS:
+        boundary(teryt, west, east)
+    # A gmina, its 7 digit teryt is not a powiat
+    boundary("9999011", 21.0, 21.02)
+    for wayId, tags, line in fixtureWays():
+        wayNodes = [node(*point) for point in line]
+        ways.append(Way(id=wayId, nodes=wayNodes, tags=tags, version=1))
+    for osmNode in nodes:
+        writer.add_node(osmNode)
+    for way in sorted(ways, key=lambda way: way.id):
+        writer.add_way(way)
+    for relation in relations:
+        writer.add_relation(relation)
+    writer.close()
+
+
+def expectedCoverage(theme: bdot.Theme, west: float, east: float) -> bdot.Coverage:
+    area = shapely.box(west, SOUTH, east, NORTH)
+    lines = [
+        line
+        for _, tags, line in fixtureWays()
+        if tags.get(theme.osmKey) in theme.osmValues
+        and shapely.LineString(line).intersects(area)
+    ]
+    if lines:
+        cells = bdot.rasterizeLines(*bdot.linesToArrays(lines))
+    else:
+        cells = np.empty(0, dtype=np.uint64)
+    return bdot.dilateCoverage(bdot.makeCoverage(cells), bdot.cachedNeighbourhoodSize())
+
+
+@unittest.skipIf(pbf.osmium is None, "requires osmium")
+class PbfCoverageTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.pbfFile = Path(directory.name) / "fixture.osm.pbf"
+        writeFixture(self.pbfFile)
+        self.cacheDir = cacheDir = Path(directory.name) / "coverage-cache"
+        cacheDir.mkdir()
+        for name, value in dict(
+            coverageCacheDir=cacheDir,
+            OSM_PBF_FILE=self.pbfFile,
+            OSM_SOURCE="pbf",
+            OSM_WORKERS=1,
+            # Batches split ways of one tag and area
+            OSM_CHUNK_SIZE=7,
+            pbfCoverageBuild=None,
+        ).items():
+            patch = mock.patch.object(bdot, name, value)
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def testReadsExtract(self):
+        self.assertEqual(pbf.pbfTimestamp(self.pbfFile), TIMESTAMP)
+        self.assertEqual(set(pbf.readTerytAreas(self.pbfFile)), {"9999", "9998"})
+
+    async def testCoverageEqualsRasterizedWays(self):
+        with self.assertLogs(level="INFO"):
+            for theme in bdot.THEMES:
+                for teryt, west, east in POWIATS:
+                    with self.subTest(theme=theme.name, teryt=teryt):
+                        coverage = await bdot.getOSMData(theme, teryt, None)
+                        expected = expectedCoverage(theme, west, east)
+                        self.assertTrue(
+                            np.array_equal(
+                                coverage.cells.toCells(), expected.cells.toCells()
+                            )
+                        )
+                        self.assertTrue(
+                            np.array_equal(coverage.coarseCells, expected.coarseCells)
+                        )
+        # Only Overpass updates need cells of each way
+        self.assertEqual(list(self.cacheDir.glob("*/wayCells.npy")), [])
+        self.assertEqual(list(self.cacheDir.glob(".tmp-*")), [])
+
+    async def testMissingPowiat(self):
+        with self.assertLogs(level="INFO"):
+            with self.assertRaises(RuntimeError):
+                await bdot.getOSMData(bdot.THEMES[0], "9997", None)
+
+
+if __name__ == "__main__":
+    unittest.main()
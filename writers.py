@@ -0,0 +1,103 @@
+import abc
+import json
+import tempfile
+from pathlib import Path
+
+import geopandas
+import pyogrio
+
+
+class FeatureWriter(abc.ABC):
+    extension: str
+
+    def __init__(self, path: Path):
+        self.path = path
+
+    def __enter__(self) -> "FeatureWriter":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @abc.abstractmethod
+    def write(self, features: geopandas.GeoDataFrame):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def close(self):
+        raise NotImplementedError
+
+
+class GeoJSONSeqWriter(FeatureWriter):
+    extension = "geojsonl"
+
+    def __init__(self, path: Path):
+        super().__init__(path)
+        self.file = path.open("w")
+
+    def write(self, features: geopandas.GeoDataFrame):
+        for feature in features.to_crs(epsg=4326).iterfeatures(na="null"):
+            self.file.write(json.dumps(feature) + "\n")
+
+    def close(self):
+        self.file.close()
+
+
+class GeoJSONWriter(GeoJSONSeqWriter):
+    extension = "geojson"
+
+    def __init__(self, path: Path):
+        super().__init__(path)
+        self.file.write('{"type": "FeatureCollection", "features": [')
+        self.empty = True
+
+    def write(self, features: geopandas.GeoDataFrame):
+        for feature in features.to_crs(epsg=4326).iterfeatures(na="null"):
+            self.file.write(("\n" if self.empty else ",\n") + json.dumps(feature))
+            self.empty = False
+
+    def close(self):
+        self.file.write("]}\n")
+        super().close()
+
+
+class FlatGeobufWriter(FeatureWriter):
+    """Writes FlatGeobuf with a packed Hilbert R-tree index.
+
+    The index precedes the features in the file, so features are spooled to
+    a temporary GeoJSONSeq file and converted when the writer is closed.
+    """
+
+    extension = "fgb"
+
+    def __init__(self, path: Path):
+        super().__init__(path)
+        self.spoolDirectory = tempfile.TemporaryDirectory(dir=path.parent)
+        self.spool = GeoJSONSeqWriter(Path(self.spoolDirectory.name) / "spool.geojsonl")
+        self.featureCount = 0
+
+    def write(self, features: geopandas.GeoDataFrame):
+        self.spool.write(features)
+        self.featureCount += len(features)
+
+    def close(self):
+        self.spool.close()
+        if self.featureCount:
+            features = geopandas.read_file(self.spool.path)
+        else:
+            features = geopandas.GeoDataFrame(geometry=[], crs="EPSG:4326")
+        pyogrio.write_dataframe(
+            features,
+            self.path,
+            driver="FlatGeobuf",
+            geometry_type="LineString",
+            SPATIAL_INDEX="YES",
+        )
+        self.spoolDirectory.cleanup()
+
+
+WRITERS: dict[str, type[FeatureWriter]] = {
+    "geojson": GeoJSONWriter,
+    "geojsonseq": GeoJSONSeqWriter,
+    "flatgeobuf": FlatGeobufWriter,
+}